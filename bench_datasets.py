@@ -0,0 +1,280 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+"""Input pipeline throughput of the training datasets.
+
+Each dataset of train_ddgan.py (celeba_256 from an LMDBDataset, lsun, stackmnist and
+cifar10) is built with its training transforms, or the uint8 ones of --batched_augment,
+over synthetic stand-in data written to --root. The DataLoader is then swept over
+num_workers, batch_size and pin_memory. For each setting the script reports samples/s,
+the CPU use of the main process and of each worker, and their resident memory:
+
+    python bench_datasets.py --datasets celeba_256 lsun --num_workers 0 4 8 --batch_sizes 32
+
+Compare the samples/s with the iterations/s of training times the batch size to see
+whether a run is input-bound.
+"""
+import argparse
+import hashlib
+import io
+import os
+import pickle
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+import lmdb
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torchvision.datasets import CIFAR10
+
+from datasets_prep.lsun import LSUN
+from datasets_prep.stackmnist_data import StackedMNIST, _data_transforms_stacked_mnist
+from datasets_prep.lmdb_datasets import LMDBDataset
+from datasets_prep.batched_augment import uint8_transform
+
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+DATASETS = ['celeba_256', 'lsun', 'stackmnist', 'cifar10']
+
+
+#%% synthetic data
+def smooth_images(rng, n, h, w):
+    """Upsampled low-resolution noise, which compresses about like photos rather than like noise."""
+    for _ in range(n):
+        small = rng.randint(0, 256, (max(1, h // 16), max(1, w // 16), 3), dtype=np.uint8)
+        yield np.asarray(Image.fromarray(small).resize((w, h), Image.BICUBIC))
+
+
+def write_lmdb(path, items):
+    env = lmdb.open(path, map_size=1 << 40)
+    with env.begin(write=True) as txn:
+        for key, value in items:
+            txn.put(key, value)
+    env.close()
+
+
+def jpeg(img):
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, format='JPEG', quality=75)
+    return buf.getvalue()
+
+
+def make_celeba(root, n, size, rng):
+    """Raw RGB bytes under the keys '0', '1', ..., as LMDBDataset reads them."""
+    write_lmdb(os.path.join(root, 'train.lmdb'),
+               ((str(i).encode(), img.tobytes()) for i, img in enumerate(smooth_images(rng, n, size, size))))
+
+
+def make_lsun(root, n, size, rng):
+    """JPEGs with the 4:3 aspect ratio of LSUN under sha1 keys."""
+    write_lmdb(os.path.join(root, 'church_outdoor_train_lmdb'),
+               ((hashlib.sha1(str(i).encode()).hexdigest().encode(), jpeg(img))
+                for i, img in enumerate(smooth_images(rng, n, size, size * 4 // 3))))
+
+
+def make_mnist(root, n, rng):
+    # torchvision looks for the files in a folder named after the dataset class
+    raw = os.path.join(root, StackedMNIST.__name__, 'raw')
+    os.makedirs(raw)
+    for split, m in [('train', n), ('t10k', max(1, n // 6))]:
+        with open(os.path.join(raw, split + '-images-idx3-ubyte'), 'wb') as f:
+            f.write(struct.pack('>IIII', 2051, m, 28, 28))
+            f.write(rng.randint(0, 256, (m, 28, 28), dtype=np.uint8).tobytes())
+        with open(os.path.join(raw, split + '-labels-idx1-ubyte'), 'wb') as f:
+            f.write(struct.pack('>II', 2049, m))
+            f.write(rng.randint(0, 10, m, dtype=np.uint8).tobytes())
+
+
+def make_cifar(root, n, rng):
+    base = os.path.join(root, CIFAR10.base_folder)
+    os.makedirs(base)
+    files = [name for name, _ in CIFAR10.train_list + CIFAR10.test_list]
+    for i, name in enumerate(files):
+        m = n // len(CIFAR10.train_list) + (i < n % len(CIFAR10.train_list)) if i < len(CIFAR10.train_list) else 1
+        entry = {'data': np.stack(list(smooth_images(rng, m, 32, 32))).transpose(0, 3, 1, 2).reshape(m, -1),
+                 'labels': rng.randint(0, 10, m).tolist()}
+        with open(os.path.join(base, name), 'wb') as f:
+            pickle.dump(entry, f)
+    with open(os.path.join(base, CIFAR10.meta['filename']), 'wb') as f:
+        pickle.dump({CIFAR10.meta['key']: [str(c) for c in range(10)]}, f)
+
+
+class SyntheticCIFAR10(CIFAR10):
+    """CIFAR10 over the files of `make_cifar`, whose checksums cannot match."""
+    def _check_integrity(self):
+        return True
+
+    def _load_meta(self):
+        with open(os.path.join(self.root, self.base_folder, self.meta['filename']), 'rb') as f:
+            self.classes = pickle.load(f)[self.meta['key']]
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+
+
+def make_data(name, root, args):
+    """Writes the stand-in data of `name` under `root` unless it is already there."""
+    if os.path.exists(root):
+        return
+    tmp = root + '.tmp'
+    os.makedirs(tmp)
+    rng = np.random.RandomState(0)
+    print('writing synthetic {} data to {}'.format(name, root), file=sys.stderr)
+    if name == 'celeba_256':
+        make_celeba(tmp, args.num_samples, args.image_size, rng)
+    elif name == 'lsun':
+        make_lsun(tmp, args.num_samples, args.image_size, rng)
+    elif name == 'stackmnist':
+        make_mnist(tmp, args.num_samples, rng)
+    elif name == 'cifar10':
+        make_cifar(tmp, args.num_samples, rng)
+    os.rename(tmp, root)
+
+
+#%% datasets
+def normalize_transform(*resize):
+    # per-sample training transforms of train_ddgan.py
+    return transforms.Compose(list(resize) + [
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+
+def build_dataset(name, root, args):
+    """The dataset train_ddgan.py builds for `name`, reading from `root`."""
+    size = args.image_size
+    if name == 'celeba_256':
+        transform = uint8_transform(size) if args.batched_augment else normalize_transform(transforms.Resize(size))
+        return LMDBDataset(root=root, name='celeba', train=True, transform=transform)
+    if name == 'lsun':
+        if args.batched_augment:
+            transform = uint8_transform(size, center_crop=True)
+        else:
+            transform = normalize_transform(transforms.Resize(size), transforms.CenterCrop(size))
+        train_data = LSUN(root=root, classes=['church_outdoor_train'], transform=transform)
+        return torch.utils.data.Subset(train_data, list(range(min(120000, len(train_data)))))
+    if name == 'stackmnist':
+        train_transform, _ = _data_transforms_stacked_mnist()
+        return StackedMNIST(root=root, train=True, download=False,
+                            transform=None if args.batched_augment else train_transform)
+    if name == 'cifar10':
+        transform = uint8_transform(32) if args.batched_augment else normalize_transform(transforms.Resize(32))
+        return SyntheticCIFAR10(root, train=True, transform=transform)
+    raise NotImplementedError('dataset %s is unknown' % name)
+
+
+#%% measurement
+def cpu_seconds(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        # the command name may contain spaces, so split after its closing parenthesis
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def memory_mb(pid):
+    """Resident and proportional set size; PSS splits pages shared with other processes."""
+    rss = pss = float('nan')
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                if line.startswith('Rss:'):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith('Pss:'):
+                    pss = int(line.split()[1]) / 1024
+    except OSError:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    return rss, pss
+
+
+def benchmark(dataset, num_workers, batch_size, pin_memory, args):
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                                         num_workers=num_workers, pin_memory=pin_memory,
+                                         drop_last=True, persistent_workers=num_workers > 0)
+    it = iter(loader)
+    # DataLoader does not expose its workers; _workers is only used to find their pids.
+    pids = [w.pid for w in getattr(it, '_workers', [])]
+    for _ in range(args.warmup):
+        next(it)
+
+    main_pid = os.getpid()
+    cpu0 = {pid: cpu_seconds(pid) for pid in [main_pid] + pids}
+    start = time.perf_counter()
+    samples = 0
+    while time.perf_counter() - start < args.min_time:
+        try:
+            x = next(it)[0]
+        except StopIteration:
+            it = iter(loader)
+            continue
+        samples += len(x)
+    elapsed = time.perf_counter() - start
+    cpu = {pid: (cpu_seconds(pid) - cpu0[pid]) / elapsed * 100 for pid in cpu0}
+    mem = {pid: memory_mb(pid) for pid in cpu0}
+    del it, loader
+
+    workers = pids or [main_pid]
+    return {
+        'samples/s': samples / elapsed,
+        'main cpu%': cpu[main_pid],
+        'worker cpu%': np.mean([cpu[pid] for pid in pids]) if pids else float('nan'),
+        'main rss MB': mem[main_pid][0],
+        'worker rss MB': np.mean([mem[pid][0] for pid in workers]) if pids else float('nan'),
+        'total pss MB': sum(mem[pid][1] for pid in cpu0),
+    }
+
+
+def main(args):
+    torch.manual_seed(0)
+    pin_memories = args.pin_memory
+    if not torch.cuda.is_available() and any(pin_memories):
+        print('no CUDA device, so pin_memory is not benchmarked', file=sys.stderr)
+        pin_memories = [0]
+
+    root = args.root or tempfile.mkdtemp(prefix='bench_datasets_')
+    try:
+        run(root, pin_memories, args)
+    finally:
+        if args.root is None:
+            shutil.rmtree(root)
+
+
+def run(root, pin_memories, args):
+    columns = ['samples/s', 'main cpu%', 'worker cpu%', 'main rss MB', 'worker rss MB', 'total pss MB']
+    print('{:<12}{:>8}{:>7}{:>5}'.format('dataset', 'workers', 'batch', 'pin')
+          + ''.join('{:>15}'.format(c) for c in columns))
+    for name in args.datasets:
+        data_root = os.path.join(root, '{}_{}_{}'.format(name, args.num_samples, args.image_size))
+        make_data(name, data_root, args)
+        dataset = build_dataset(name, data_root, args)
+        for num_workers in args.num_workers:
+            for batch_size in args.batch_sizes:
+                for pin_memory in pin_memories:
+                    result = benchmark(dataset, num_workers, batch_size, bool(pin_memory), args)
+                    print('{:<12}{:>8}{:>7}{:>5}'.format(name, num_workers, batch_size, pin_memory)
+                          + ''.join('{:>15.1f}'.format(result[c]) for c in columns), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('dataset throughput benchmark')
+    parser.add_argument('--datasets', nargs='+', default=DATASETS, choices=DATASETS)
+    parser.add_argument('--root', default=None,
+                        help='directory for the synthetic data, kept and reused; a temporary one by default')
+    parser.add_argument('--num_samples', type=int, default=2000,
+                        help='images per synthetic dataset (MNIST digits for stackmnist)')
+    parser.add_argument('--image_size', type=int, default=256, help='image size of celeba_256 and lsun')
+    parser.add_argument('--batched_augment', action='store_true', default=False,
+                        help='use the uint8 transforms of --batched_augment')
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 2, 4, 8])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 128])
+    parser.add_argument('--pin_memory', type=int, nargs='+', default=[0, 1], choices=[0, 1])
+    parser.add_argument('--warmup', type=int, default=2, help='batches before timing')
+    parser.add_argument('--min_time', type=float, default=5., help='seconds timed per setting')
+    args = parser.parse_args()
+    main(args)
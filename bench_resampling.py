@@ -0,0 +1,318 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+"""CPU equivalence checks and benchmarks for the resampling ops.
+
+Every op is compared against a naive reference (explicit zero stuffing, padding and a
+tap-by-tap correlation) on its output, its first-order gradients and its second-order
+gradients (the gradient of the gradient, which R1 relies on), for both memory formats.
+It is then timed and its peak memory recorded, so a new implementation of any of these
+ops can be dropped in and checked with
+
+    python bench_resampling.py --resolutions 32 64 --batch_sizes 1 8 --channels 64 128
+
+The exit status is non-zero if any check fails.
+"""
+import argparse
+import itertools
+import resource
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+from score_sde.op.upfirdn2d import upfirdn2d_native, upfirdn2d_ada
+from score_sde.models import up_or_down_sampling as resampling
+
+
+KERNELS = {
+    'box': [1, 1],
+    'binomial': [1, 3, 3, 1],
+    'binomial6': [1, 5, 10, 10, 5, 1],
+}
+
+
+def ref_upfirdn2d(x, k, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1):
+    """Zero stuffing, padding (negative values crop) and a correlation with the flipped kernel."""
+    n, c, h, w = x.shape
+    k = torch.as_tensor(k, dtype=x.dtype)
+    if k.ndim == 1:
+        k = torch.outer(k, k)
+    kh, kw = k.shape
+
+    out = x.new_zeros(n, c, h * up_y, w * up_x)
+    out[:, :, ::up_y, ::up_x] = x
+    out = F.pad(out, [pad_x0, pad_x1, pad_y0, pad_y1])
+    out_h = out.shape[2] - kh + 1
+    out_w = out.shape[3] - kw + 1
+
+    k = torch.flip(k, [0, 1])
+    acc = 0
+    for i in range(kh):
+        for j in range(kw):
+            acc = acc + k[i, j] * out[:, :, i:i + out_h, j:j + out_w]
+    return acc[:, :, ::down_y, ::down_x]
+
+
+def ref_conv2d(x, w, stride=1, padding=0):
+    """Cross-correlation of `x` with `w` (out_ch, in_ch, kh, kw) as a sum over taps."""
+    kh, kw = w.shape[2:]
+    x = F.pad(x, [padding] * 4)
+    out_h = x.shape[2] - kh + 1
+    out_w = x.shape[3] - kw + 1
+    acc = 0
+    for i in range(kh):
+        for j in range(kw):
+            acc = acc + torch.einsum('oc,nchw->nohw', w[:, :, i, j], x[:, :, i:i + out_h, j:j + out_w])
+    return acc[:, :, ::stride, ::stride]
+
+
+def ref_naive_downsample_2d(x, factor):
+    n, c, h, w = x.shape
+    x = x[:, :, :h // factor * factor, :w // factor * factor]
+    return x.reshape(n, c, h // factor, factor, w // factor, factor).mean((3, 5))
+
+
+def _fir(k, gain):
+    return torch.tensor(resampling._setup_kernel(k) * gain, dtype=torch.float64)
+
+
+def ref_upsample_2d(x, k, factor):
+    k = _fir(k, factor ** 2)
+    p = k.shape[0] - factor
+    pad = ((p + 1) // 2 + factor - 1, p // 2)
+    return ref_upfirdn2d(x, k.to(x.dtype), factor, factor, 1, 1, *pad, *pad)
+
+
+def ref_downsample_2d(x, k, factor):
+    k = _fir(k, 1)
+    p = k.shape[0] - factor
+    pad = ((p + 1) // 2, p // 2)
+    return ref_upfirdn2d(x, k.to(x.dtype), 1, 1, factor, factor, *pad, *pad)
+
+
+def ref_upsample_conv_2d(x, w, k, factor):
+    """`upsample_2d` without cropping its filter tails, then a 'valid' conv.
+
+    Cropping the upsampled image to H * factor before a padded conv, as the unfused
+    layers do, only differs from this within the conv radius of the borders.
+    """
+    k = _fir(k, factor ** 2)
+    p = k.shape[0] - factor
+    r = w.shape[-1] // 2
+    pad = ((p + 1) // 2 + factor - 1 + r, p // 2 + r)
+    x = ref_upfirdn2d(x, k.to(x.dtype), factor, factor, 1, 1, *pad, *pad)
+    return ref_conv2d(x, w)
+
+
+def ref_conv_downsample_2d(x, w, k, factor):
+    k = _fir(k, 1)
+    p = (k.shape[0] - factor) + (w.shape[-1] - 1)
+    pad = ((p + 1) // 2, p // 2)
+    x = ref_upfirdn2d(x, k.to(x.dtype), 1, 1, 1, 1, *pad, *pad)
+    return ref_conv2d(x, w, stride=factor)
+
+
+def build_cases(args):
+    """Yield (name, check dtype, op, reference, conv kernel size or None for ops without weights)."""
+    for kname, factor in itertools.product(args.kernels, args.factors):
+        k = KERNELS[kname]
+        fir = _fir(k, 1)
+        p = fir.shape[0] - factor
+        pad = ((p + 1) // 2, p // 2)
+        tag = '{} x{}'.format(kname, factor)
+
+        def native_up(x, fir=fir, factor=factor, pad=pad):
+            return upfirdn2d_native(x, fir.to(x.dtype), factor, factor, 1, 1, *pad, *pad)
+
+        def ref_up(x, fir=fir, factor=factor, pad=pad):
+            return ref_upfirdn2d(x, fir, factor, factor, 1, 1, *pad, *pad)
+
+        def native_down(x, fir=fir, factor=factor, pad=pad):
+            return upfirdn2d_native(x, fir.to(x.dtype), 1, 1, factor, factor, *pad, *pad)
+
+        def ref_down(x, fir=fir, factor=factor, pad=pad):
+            return ref_upfirdn2d(x, fir, 1, 1, factor, factor, *pad, *pad)
+
+        def native_sep(x, k=k, factor=factor, pad=pad):
+            k = torch.tensor(k, dtype=x.dtype) / sum(k)
+            return upfirdn2d_native(x, k, factor, factor, 1, 1, *pad, *pad)
+
+        def ada(x, fir=fir, factor=factor, pad=pad):
+            # Anisotropic: upsample along x only, downsample along y only.
+            return upfirdn2d_ada(x, fir.to(x.dtype), up=(factor, 1), down=(1, factor),
+                                 pad=(pad[0], pad[1], pad[1], pad[0]))
+
+        def ref_ada(x, fir=fir, factor=factor, pad=pad):
+            return ref_upfirdn2d(x, fir, factor, 1, 1, factor, pad[0], pad[1], pad[1], pad[0])
+
+        def up_down(x, fir=fir, factor=factor, pad=pad):
+            return upfirdn2d_native(x, fir.to(x.dtype), factor, factor, factor, factor, *pad, *pad)
+
+        def ref_up_down(x, fir=fir, factor=factor, pad=pad):
+            return ref_upfirdn2d(x, fir, factor, factor, factor, factor, *pad, *pad)
+
+        yield 'upfirdn2d_native up ' + tag, torch.float64, native_up, ref_up, None
+        yield 'upfirdn2d_native down ' + tag, torch.float64, native_down, ref_down, None
+        yield 'upfirdn2d_native up+down ' + tag, torch.float64, up_down, ref_up_down, None
+        yield 'upfirdn2d_native 1-D ' + tag, torch.float64, native_sep, ref_up, None
+        yield 'upfirdn2d_ada ' + tag, torch.float64, ada, ref_ada, None
+
+        # The helpers below build their FIR filters in float32.
+        yield ('upsample_2d ' + tag, torch.float32,
+               lambda x, k=k, f=factor: resampling.upsample_2d(x, k, factor=f),
+               lambda x, k=k, f=factor: ref_upsample_2d(x, k, f), None)
+        yield ('downsample_2d ' + tag, torch.float32,
+               lambda x, k=k, f=factor: resampling.downsample_2d(x, k, factor=f),
+               lambda x, k=k, f=factor: ref_downsample_2d(x, k, f), None)
+        yield ('upsample_conv_2d ' + tag, torch.float32,
+               lambda x, w, k=k, f=factor: resampling.upsample_conv_2d(x, w, k, factor=f),
+               lambda x, w, k=k, f=factor: ref_upsample_conv_2d(x, w, k, f), 3)
+        yield ('conv_downsample_2d ' + tag, torch.float32,
+               lambda x, w, k=k, f=factor: resampling.conv_downsample_2d(x, w, k, factor=f),
+               lambda x, w, k=k, f=factor: ref_conv_downsample_2d(x, w, k, f), 3)
+
+    for factor in args.factors:
+        yield ('naive_upsample_2d x{}'.format(factor), torch.float64,
+               lambda x, f=factor: resampling.naive_upsample_2d(x, f),
+               lambda x, f=factor: x.repeat_interleave(f, 2).repeat_interleave(f, 3), None)
+        yield ('naive_downsample_2d x{}'.format(factor), torch.float64,
+               lambda x, f=factor: resampling.naive_downsample_2d(x, f),
+               lambda x, f=factor: ref_naive_downsample_2d(x, f), None)
+
+
+def _grads(fn, inputs, seed):
+    """Output, first-order and second-order gradients of `fn` w.r.t. `inputs`.
+
+    The second-order pass differentiates the first-order gradients w.r.t. the
+    cotangent and the inputs, so it covers double backward of linear ops too.
+    """
+    out = fn(*inputs)
+    gen = torch.Generator().manual_seed(seed)
+    cot = torch.randn(out.shape, generator=gen, dtype=out.dtype).requires_grad_()
+    first = torch.autograd.grad(out, inputs, cot, create_graph=True)
+    dirs = [torch.randn(g.shape, generator=gen, dtype=g.dtype) for g in first]
+    second = torch.autograd.grad(first, [cot, *inputs], dirs, allow_unused=True)
+    second = [torch.zeros_like(t) if g is None else g for g, t in zip(second, [cot, *inputs])]
+    return [out, *first, *second]
+
+
+def _rel_err(a, b):
+    return ((a.detach() - b.detach()).abs().max() / b.detach().abs().max().clamp(min=1)).item()
+
+
+def check(op, ref, dtype, shape, wk, memory_format, seed=0):
+    """Worst relative error of the output and gradients, and whether the output kept `memory_format`."""
+    gen = torch.Generator().manual_seed(seed)
+    x = torch.randn(shape, generator=gen, dtype=dtype)
+    inputs = [x]
+    if wk is not None:
+        inputs.append(torch.randn(shape[1], shape[1], wk, wk, generator=gen, dtype=dtype) / (shape[1] * wk))
+
+    def run(fn, fmt):
+        tensors = [inputs[0].contiguous(memory_format=fmt).requires_grad_()]
+        tensors += [t.clone().requires_grad_() for t in inputs[1:]]
+        return _grads(fn, tensors, seed)
+
+    results = run(op, memory_format)
+    expected = run(ref, torch.contiguous_format)
+    kept = memory_format == torch.contiguous_format or results[0].is_contiguous(memory_format=memory_format)
+    return max(_rel_err(a, b) for a, b in zip(results, expected)), kept
+
+
+def peak_memory(fn):
+    """Peak bytes allocated while running `fn`, from the profiler or else the growth of the peak RSS."""
+    try:
+        from torch.profiler import profile, ProfilerActivity
+    except ImportError:
+        profile = None
+    if profile is None:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    # Allocations are attributed to the op that makes them, frees to '[memory]' events.
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def benchmark(op, dtype, shape, wk, memory_format, backward, min_time):
+    x = torch.randn(shape, dtype=dtype).contiguous(memory_format=memory_format)
+    inputs = [x.requires_grad_(backward)]
+    if wk is not None:
+        inputs.append(torch.randn(shape[1], shape[1], wk, wk, dtype=dtype).requires_grad_(backward))
+
+    def step():
+        out = op(*inputs)
+        if backward:
+            out.sum().backward()
+
+    if not backward:
+        step = torch.no_grad()(step)
+
+    step()
+    iters = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        step()
+        iters += 1
+    elapsed = time.perf_counter() - start
+    return iters / elapsed, peak_memory(step)
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    formats = {'contiguous': torch.contiguous_format, 'channels_last': torch.channels_last}
+    failures = 0
+
+    print('{:<36} {:>3} {:>5} {:>4} {:<13} {:>9} {:>3} {:>10} {:>9}'.format(
+        'op', 'bs', 'ch', 'res', 'format', 'max err', 'ok', 'ops/s', 'peak MB'))
+    for name, dtype, op, ref, wk in build_cases(args):
+        for res, bs, ch, fmt in itertools.product(args.resolutions, args.batch_sizes, args.channels, args.formats):
+            shape = (bs, ch, res, res)
+            tol = args.tol64 if dtype == torch.float64 else args.tol32
+
+            # Reference gradients are slow, so they are checked on a small slice of the sweep.
+            check_shape = (min(bs, 2), min(ch, args.check_channels), min(res, args.check_resolution),
+                           min(res, args.check_resolution))
+            err, kept = check(op, ref, dtype, check_shape, wk, formats[fmt])
+            ok = err <= tol and kept
+            failures += not ok
+
+            ops, peak = benchmark(op, torch.float32, shape, wk, formats[fmt], args.backward, args.min_time)
+            print('{:<36} {:>3} {:>5} {:>4} {:<13} {:>9.2e} {:>3} {:>10.1f} {:>9.1f}'.format(
+                name, bs, ch, res, fmt, err, 'yes' if ok else 'NO', ops, peak / 2 ** 20))
+            if not kept:
+                print('  output did not keep the {} memory format'.format(fmt))
+
+    print('{} check(s) failed'.format(failures) if failures else 'all checks passed')
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('resampling op benchmark')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[16, 64])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--channels', type=int, nargs='+', default=[64, 256])
+    parser.add_argument('--kernels', nargs='+', choices=sorted(KERNELS), default=['box', 'binomial'])
+    parser.add_argument('--factors', type=int, nargs='+', default=[2])
+    parser.add_argument('--formats', nargs='+', choices=['contiguous', 'channels_last'],
+                        default=['contiguous', 'channels_last'])
+    parser.add_argument('--backward', action='store_true', help='time forward and backward passes')
+    parser.add_argument('--min_time', type=float, default=0.5, help='seconds spent timing each configuration')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--check_channels', type=int, default=8, help='channel cap for the reference checks')
+    parser.add_argument('--check_resolution', type=int, default=16, help='resolution cap for the reference checks')
+    parser.add_argument('--tol64', type=float, default=1e-10)
+    parser.add_argument('--tol32', type=float, default=1e-5)
+    args = parser.parse_args()
+    sys.exit(1 if main(args) else 0)
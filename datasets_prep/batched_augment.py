@@ -0,0 +1,38 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+"""Augmentation and normalization of whole collated batches on the training device.
+
+With `--batched_augment` the datasets only decode (and resize or crop, where image
+sizes differ) to uint8 tensors, a quarter of the float payload between workers and
+the trainer. The flip, padding and scaling to [-1, 1] that the per-sample transforms
+did are then applied once per batch by `batched_augment`.
+"""
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+
+def uint8_transform(image_size=None, center_crop=False):
+    """Per-sample transform to a (C, H, W) uint8 tensor: optional resize and center crop only."""
+    t = []
+    if image_size is not None:
+        t.append(transforms.Resize(image_size))
+        if center_crop:
+            t.append(transforms.CenterCrop(image_size))
+    t.append(transforms.PILToTensor())
+    return transforms.Compose(t)
+
+
+def batched_augment(x, flip=True, pad=0):
+    """Zero-pad, randomly flip each image horizontally and scale a uint8 (N, C, H, W) batch to [-1, 1]."""
+    if pad:
+        x = F.pad(x, [pad] * 4)
+    if flip:
+        mask = torch.rand(x.size(0), device=x.device) < 0.5
+        x = torch.where(mask[:, None, None, None], x.flip(3), x)
+    return x.float().div_(127.5).sub_(1.)
@@ -0,0 +1,66 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+"""Serve a small dataset from a single uint8 tensor, without DataLoader workers."""
+
+import math
+
+import numpy as np
+import torch
+from torchvision.datasets import CIFAR10
+
+from datasets_prep.stackmnist_data import StackedMNIST
+from datasets_prep.memmap_dataset import MemmapDataset
+
+
+def dataset_tensors(dataset):
+    """All images of `dataset` as one (N, C, H, W) uint8 tensor, and their targets."""
+    if isinstance(dataset, CIFAR10):
+        images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+        return images, torch.tensor(dataset.targets)
+    if isinstance(dataset, StackedMNIST):
+        assert dataset.transform is None, 'StackedMNIST must return uint8 images'
+        return dataset[list(range(len(dataset)))]
+    if isinstance(dataset, MemmapDataset):
+        images = torch.from_numpy(np.load(dataset.path)).permute(0, 3, 1, 2).contiguous()
+        return images, torch.zeros(len(images), dtype=torch.long)
+    raise NotImplementedError('%s cannot be held in memory' % type(dataset).__name__)
+
+
+class InMemoryLoader:
+    """Yields (images, targets) batches gathered from tensors kept on `device`.
+
+    Each epoch draws the same per-rank indices as a DistributedSampler with the same
+    seed, and like DataLoader(drop_last=True) only yields full batches. Call `set_epoch`
+    before iterating.
+    """
+    def __init__(self, images, targets, batch_size, num_replicas=1, rank=0, seed=0, device='cpu'):
+        self.images = images.to(device)
+        self.targets = targets.to(device)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = math.ceil(len(self.images) / num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples // self.batch_size
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.images), generator=g)
+        # Pad to a multiple of the number of replicas, as DistributedSampler does.
+        total_size = self.num_samples * self.num_replicas
+        indices = indices.repeat(math.ceil(total_size / len(indices)))[:total_size]
+        indices = indices[self.rank:total_size:self.num_replicas].to(self.images.device)
+        for i in range(len(self)):
+            batch = indices[i * self.batch_size:(i + 1) * self.batch_size]
+            yield self.images[batch], self.targets[batch]
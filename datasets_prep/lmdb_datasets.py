@@ -13,40 +13,65 @@ import io
 from PIL import Image
 
 
-def num_samples(dataset, train):
-    if dataset == 'celeba':
-        return 27000 if train else 3000
-    
-    else:
-        raise NotImplementedError('dataset %s is unknown' % dataset)
-
-
 class LMDBDataset(data.Dataset):
+    """Images stored under the keys '0', '1', ... of `root`/{train,validation}.lmdb.
+
+    The environment is opened lazily in the process that reads from it, so every
+    DataLoader worker gets its own environment and a read transaction and cursor
+    that live as long as the worker.
+    """
     def __init__(self, root, name='', train=True, transform=None, is_encoded=False):
         self.train = train
         self.name = name
         self.transform = transform
         if self.train:
-            lmdb_path = os.path.join(root, 'train.lmdb')
+            self.lmdb_path = os.path.join(root, 'train.lmdb')
         else:
-            lmdb_path = os.path.join(root, 'validation.lmdb')
-        self.data_lmdb = lmdb.open(lmdb_path, readonly=True, max_readers=1,
-                                   lock=False, readahead=False, meminit=False)
+            self.lmdb_path = os.path.join(root, 'validation.lmdb')
         self.is_encoded = is_encoded
 
+        env = self._open_env()
+        with env.begin(write=False) as txn:
+            self.length = txn.stat()['entries']
+        env.close()
+        self.data_lmdb = None
+        self.pid = None
+
+    def _open_env(self):
+        return lmdb.open(self.lmdb_path, readonly=True, max_readers=1,
+                         lock=False, readahead=False, meminit=False)
+
+    def _open(self):
+        # An environment must not be used across fork, so a new process opens its own.
+        if self.data_lmdb is None or self.pid != os.getpid():
+            if self.data_lmdb is not None:
+                # inherited from the parent; lmdb refuses to open a second handle
+                self.data_lmdb.close()
+            self.data_lmdb = self._open_env()
+            self.txn = self.data_lmdb.begin(write=False, buffers=True)
+            self.cursor = self.txn.cursor()
+            self.pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('data_lmdb', 'txn', 'cursor', 'pid'):
+            state[key] = None
+        return state
+
     def __getitem__(self, index):
         target = [0]
-        with self.data_lmdb.begin(write=False, buffers=True) as txn:
-            data = txn.get(str(index).encode())
-            if self.is_encoded:
-                img = Image.open(io.BytesIO(data))
-                img = img.convert('RGB')
-            else:
-                img = np.asarray(data, dtype=np.uint8)
-                # assume data is RGB
-                size = int(np.sqrt(len(img) / 3))
-                img = np.reshape(img, (size, size, 3))
-                img = Image.fromarray(img, mode='RGB')
+        self._open()
+        # The buffer is only valid until the next read, so it is decoded right away.
+        data = self.cursor.get(str(index).encode())
+        if self.is_encoded:
+            img = Image.open(io.BytesIO(data))
+            img = img.convert('RGB')
+        else:
+            img = np.asarray(data, dtype=np.uint8)
+            # assume data is RGB
+            size = int(np.sqrt(len(img) / 3))
+            img = np.reshape(img, (size, size, 3))
+            img = Image.fromarray(img, mode='RGB')
 
         if self.transform is not None:
             img = self.transform(img)
@@ -54,5 +79,4 @@ class LMDBDataset(data.Dataset):
         return img, target
 
     def __len__(self):
-        return num_samples(self.name, self.train)
-
+        return self.length
@@ -14,9 +14,11 @@
 
 from torchvision.datasets.vision import VisionDataset
 from PIL import Image
+import numpy as np
 import os
 import os.path
 import io
+import bisect
 import string
 from collections.abc import Iterable
 import pickle
@@ -38,18 +40,27 @@ class LSUNClass(VisionDataset):
         # We only modified the location of cache_file.
         cache_file = os.path.join(self.root, '_cache_')
         # av end
-        if os.path.isfile(cache_file):
-            self.keys = pickle.load(open(cache_file, "rb"))
-        else:
-            with self.env.begin(write=False) as txn:
-                self.keys = [key for key, _ in txn.cursor()]
-            pickle.dump(self.keys, open(cache_file, "wb"))
+        # The keys are kept as one fixed-width bytes array, memory-mapped so that every
+        # worker shares the same pages instead of unpickling its own list of objects.
+        keys_file = os.path.join(self.root, '_cache_keys.npy')
+        if not os.path.isfile(keys_file):
+            if os.path.isfile(cache_file):
+                keys = pickle.load(open(cache_file, "rb"))
+            else:
+                with self.env.begin(write=False) as txn:
+                    keys = list(txn.cursor().iternext(values=False))
+            # written under a temporary name so concurrent readers never see a partial file
+            tmp_file = '{}.{}.tmp'.format(keys_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                np.save(f, np.array(keys, dtype=np.bytes_))
+            os.replace(tmp_file, keys_file)
+        self.keys = np.load(keys_file, mmap_mode='r')
 
     def __getitem__(self, index):
         img, target = None, -1
         env = self.env
         with env.begin(write=False) as txn:
-            imgbuf = txn.get(self.keys[index])
+            imgbuf = txn.get(bytes(self.keys[index]))
 
         buf = io.BytesIO()
         buf.write(imgbuf)
@@ -146,13 +157,8 @@ class LSUN(VisionDataset):
         Returns:
             tuple: Tuple (image, target) where target is the index of the target category.
         """
-        target = 0
-        sub = 0
-        for ind in self.indices:
-            if index < ind:
-                break
-            target += 1
-            sub = ind
+        target = bisect.bisect_right(self.indices, index)
+        sub = self.indices[target - 1] if target > 0 else 0
 
         db = self.dbs[target]
         index = index - sub
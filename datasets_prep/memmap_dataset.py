@@ -0,0 +1,128 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+"""Pre-decoded, pre-resized uint8 images in a memory-mapped .npy file.
+
+Decode an LSUN or CelebA LMDB once:
+
+    python -m datasets_prep.memmap_dataset --dataset lsun --root /datasets/LSUN/ \
+        --classes church_outdoor_train --image_size 256 --max_samples 120000 --output church_256.npy
+
+and train from the result with `--memmap_path church_256.npy`. The file is opened
+read-only, so concurrent runs on a node share it through the page cache.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import torch
+import torch.utils.data as data
+import torchvision.transforms as transforms
+
+
+class MemmapDataset(data.Dataset):
+    """Serves the (N, H, W, 3) uint8 array written by `convert`.
+
+    Returns (C, H, W) float tensors in [-1, 1], randomly flipped if `flip`, like the
+    Resize/CenterCrop/RandomHorizontalFlip/ToTensor/Normalize pipelines of train_ddgan.py,
+    or with `uint8` the unflipped uint8 images for `batched_augment`.
+    """
+    def __init__(self, path, flip=True, uint8=False):
+        self.path = path
+        self.flip = flip and not uint8
+        self.uint8 = uint8
+        self.data = None
+        self.length = len(self._open())
+
+    def _open(self):
+        return np.load(self.path, mmap_mode='r')
+
+    def __getstate__(self):
+        # Pickling a memmap would copy the whole array into the worker.
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def __getitem__(self, index):
+        if self.data is None:
+            self.data = self._open()
+        img = self.data[index]
+        if self.flip and torch.rand(1).item() < 0.5:
+            img = img[:, ::-1]
+        # The only copy: out of the page cache into a tensor.
+        img = torch.from_numpy(np.array(img)).permute(2, 0, 1)
+        if not self.uint8:
+            img = img.float().div_(127.5).sub_(1.)
+        return img, 0
+
+    def __len__(self):
+        return self.length
+
+
+def _stack_images(batch):
+    return np.stack([img for img, _ in batch])
+
+
+def convert(dataset, output, num_workers=4, batch_size=256):
+    """Write every image of `dataset` (already resized to a fixed size) to `output`.
+
+    The array is written to a temporary file that is renamed once complete, so a
+    reader never sees a partial file.
+    """
+    loader = data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                             collate_fn=_stack_images)
+    tmp = output + '.tmp'
+    out = None
+    start = 0
+    for batch in loader:
+        if out is None:
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8,
+                                            shape=(len(dataset),) + batch.shape[1:])
+        out[start:start + len(batch)] = batch
+        start += len(batch)
+        print('{}/{}'.format(start, len(dataset)), end='\r')
+    out.flush()
+    del out
+    os.replace(tmp, output)
+    print('\nwrote {} images to {}'.format(start, output))
+
+
+def main(args):
+    # The datasets already convert to RGB, so this yields (H, W, 3) uint8 arrays.
+    transform = transforms.Compose([
+        transforms.Resize(args.image_size),
+        transforms.CenterCrop(args.image_size),
+        np.asarray,
+    ])
+    if args.dataset == 'lsun':
+        from datasets_prep.lsun import LSUN
+        dataset = LSUN(root=args.root, classes=args.classes, transform=transform)
+    elif args.dataset == 'celeba_256':
+        from datasets_prep.lmdb_datasets import LMDBDataset
+        dataset = LMDBDataset(root=args.root, name='celeba', train=not args.validation, transform=transform)
+    else:
+        raise NotImplementedError('dataset %s is unknown' % args.dataset)
+
+    if args.max_samples is not None:
+        dataset = data.Subset(dataset, list(range(min(args.max_samples, len(dataset)))))
+    convert(dataset, args.output, num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('memmap dataset conversion')
+    parser.add_argument('--dataset', default='lsun', choices=['lsun', 'celeba_256'])
+    parser.add_argument('--root', default='/datasets/LSUN/')
+    parser.add_argument('--classes', nargs='+', default=['church_outdoor_train'], help='LSUN classes')
+    parser.add_argument('--validation', action='store_true', default=False,
+                        help='convert the validation split of an LMDBDataset')
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--max_samples', type=int, default=None,
+                        help='only convert the first max_samples images')
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,144 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+"""A node-local cache of decoded samples in shared memory.
+
+Every rank of a node and all of their DataLoader workers read through the same cache,
+so each sample is decoded once per node instead of once per rank. The cache holds a
+fixed number of slots in /dev/shm and evicts the least recently used sample when full.
+"""
+
+import contextlib
+import fcntl
+import json
+import multiprocessing.util
+import os
+import shutil
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+
+class SharedMemoryCache(data.Dataset):
+    """Serves `dataset` through a bounded LRU cache of its samples in the directory `path`.
+
+    The samples must be uint8 tensors of a fixed shape, e.g. with --batched_augment, since
+    anything random done per sample would be frozen into the cache. Targets are kept as
+    integers.
+
+    Exactly one process per node constructs the cache with `create=True`, which sizes the
+    slots from `size_bytes`. The others must only read from it after that, e.g. after a
+    barrier. That process calls `destroy` once every reader is done; should it exit before,
+    e.g. on an exception, the cache is removed as it exits.
+    """
+    def __init__(self, dataset, path, size_bytes=None, create=False):
+        self.dataset = dataset
+        self.path = path
+        self._finalizer = None
+        if create:
+            self._create(size_bytes)
+        self.pid = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _create(self, size_bytes):
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        # Unlike atexit, this also runs when a multiprocessing.Process exits, and only in
+        # this process, not in forked DataLoader workers.
+        self._finalizer = multiprocessing.util.Finalize(
+            None, shutil.rmtree, args=(self.path,), kwargs={'ignore_errors': True}, exitpriority=0)
+        img, _ = self.dataset[0]
+        num_slots = int(min(len(self.dataset), max(1, size_bytes // img.numel())))
+        meta = {'shape': list(img.shape), 'num_slots': num_slots, 'length': len(self.dataset)}
+        with open(self._file('meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        np.memmap(self._file('images'), np.uint8, 'w+', shape=(num_slots,) + tuple(img.shape)).flush()
+        for name, length, value in [('slot_of', len(self.dataset), -1), ('key_of', num_slots, -1),
+                                    ('last_used', num_slots, 0), ('targets', num_slots, 0),
+                                    ('state', 2, 0)]:
+            table = np.memmap(self._file(name), np.int64, 'w+', shape=(length,))
+            table[:] = value
+            table.flush()
+
+    def _open(self):
+        # flock only excludes separate open file descriptions, so every process,
+        # including forked workers, opens the lock file itself.
+        if self.pid != os.getpid():
+            with open(self._file('meta.json')) as f:
+                meta = json.load(f)
+            num_slots, length = meta['num_slots'], meta['length']
+            self.images = np.memmap(self._file('images'), np.uint8, 'r+',
+                                    shape=(num_slots,) + tuple(meta['shape']))
+            # slot_of: slot holding each sample or -1; key_of: sample held by each slot or -1;
+            # last_used: LRU clock of each slot; state: [clock, number of slots in use]
+            self.slot_of = np.memmap(self._file('slot_of'), np.int64, 'r+', shape=(length,))
+            self.key_of = np.memmap(self._file('key_of'), np.int64, 'r+', shape=(num_slots,))
+            self.last_used = np.memmap(self._file('last_used'), np.int64, 'r+', shape=(num_slots,))
+            self.targets = np.memmap(self._file('targets'), np.int64, 'r+', shape=(num_slots,))
+            self.state = np.memmap(self._file('state'), np.int64, 'r+', shape=(2,))
+            self.lock_file = open(self._file('lock'), 'a')
+            self.pid = os.getpid()
+
+    def __getstate__(self):
+        state = {key: value for key, value in self.__dict__.items()
+                 if key in ('dataset', 'path')}
+        state['pid'] = None
+        state['_finalizer'] = None
+        return state
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _touch(self, slot):
+        self.state[0] += 1
+        self.last_used[slot] = self.state[0]
+
+    def _allocate(self):
+        if self.state[1] < len(self.key_of):
+            self.state[1] += 1
+            return int(self.state[1] - 1)
+        slot = int(np.argmin(self.last_used))
+        self.slot_of[self.key_of[slot]] = -1
+        return slot
+
+    def __getitem__(self, index):
+        self._open()
+        with self._locked():
+            slot = self.slot_of[index]
+            if slot >= 0:
+                self._touch(slot)
+                return torch.from_numpy(np.array(self.images[slot])), int(self.targets[slot])
+
+        # Decode outside the lock; if another process cached the sample meanwhile, keep its copy.
+        img, target = self.dataset[index]
+        target = int(torch.as_tensor(target).item())
+        with self._locked():
+            if self.slot_of[index] < 0:
+                slot = self._allocate()
+                self.images[slot] = img.numpy()
+                self.targets[slot] = target
+                self.key_of[slot] = index
+                self.slot_of[index] = slot
+                self._touch(slot)
+        return img, target
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def destroy(self):
+        if self._finalizer is not None:
+            self._finalizer()
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
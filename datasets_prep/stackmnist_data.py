@@ -7,12 +7,18 @@
 
 
 import numpy as np
-from PIL import Image
+import torch
 import torchvision.datasets as dset
 import torchvision.transforms as transforms
 
 
 class StackedMNIST(dset.MNIST):
+    """Three MNIST digits stacked as the channels of one image, labelled by the 3-digit number.
+
+    Images are (3, 28, 28) uint8 tensors and `transform` is applied to tensors. A list
+    of indices, as passed to `__getitems__` by the DataLoader, builds the whole batch
+    with one gather over `self.data`.
+    """
     def __init__(self, root, train=True, transform=None, target_transform=None,
                  download=False):
         super(StackedMNIST, self).__init__(root=root, train=train, transform=transform,
@@ -23,22 +29,18 @@ class StackedMNIST(dset.MNIST):
         index3 = np.hstack([np.random.permutation(len(self.data)), np.random.permutation(len(self.data))])
         self.num_images = 2 * len(self.data)
 
-        self.index = []
-        for i in range(self.num_images):
-            self.index.append((index1[i], index2[i], index3[i]))
+        self.index = torch.from_numpy(np.stack([index1, index2, index3], axis=1))
+        self.digit_weights = torch.tensor([100, 10, 1])
 
     def __len__(self):
         return self.num_images
 
     def __getitem__(self, index):
-        img = np.zeros((28, 28, 3), dtype=np.uint8)
-        target = 0
-        for i in range(3):
-            img_, target_ = self.data[self.index[index][i]], int(self.targets[self.index[index][i]])
-            img[:, :, i] = img_
-            target += target_ * 10 ** (2 - i)
-
-        img = Image.fromarray(img, mode="RGB")
+        idx = self.index[index]
+        img = self.data[idx]
+        target = (self.targets[idx] * self.digit_weights).sum(-1)
+        if idx.dim() == 1:
+            target = int(target)
 
         if self.transform is not None:
             img = self.transform(img)
@@ -48,17 +50,21 @@ class StackedMNIST(dset.MNIST):
 
         return img, target
 
+    def __getitems__(self, indices):
+        img, target = self[list(indices)]
+        return list(zip(img, target))
+
 def _data_transforms_stacked_mnist():
     """Get data transforms for cifar10."""
     train_transform = transforms.Compose([
         transforms.Pad(padding=2),
-        transforms.ToTensor(),
+        transforms.ConvertImageDtype(torch.float),
         transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5))
     ])
 
     valid_transform = transforms.Compose([
         transforms.Pad(padding=2),
-        transforms.ToTensor(),
+        transforms.ConvertImageDtype(torch.float),
         transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5))
     ])
 
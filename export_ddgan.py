@@ -0,0 +1,98 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+"""Export a generator and its sampling loop to a single TorchScript file.
+
+    python export_ddgan.py export --dataset cifar10 --exp ddgan_cifar10_exp1 ... --output sampler.pt
+    python export_ddgan.py sample --sampler sampler.pt --output samples.jpg
+
+`sample` only needs torch and torchvision, not this repository.
+"""
+import argparse
+import sys
+
+import torch
+import torch.nn as nn
+
+
+class Sampler(nn.Module):
+    """Runs the full reverse chain of a traced generator, as sample_from_model does."""
+
+    def __init__(self, generator, pos_coeff, args):
+        super().__init__()
+        self.generator = generator
+        self.register_buffer('posterior_mean_coef1', pos_coeff.posterior_mean_coef1.cpu())
+        self.register_buffer('posterior_mean_coef2', pos_coeff.posterior_mean_coef2.cpu())
+        self.register_buffer('posterior_log_variance_clipped', pos_coeff.posterior_log_variance_clipped.cpu())
+        self.num_timesteps = args.num_timesteps
+        self.nz = args.nz
+        self.batch_size = args.batch_size
+        self.num_channels = args.num_channels
+        self.image_size = args.image_size
+
+    def forward(self, x_init: torch.Tensor) -> torch.Tensor:
+        x = x_init
+        for i in range(self.num_timesteps - 1, -1, -1):
+            t = torch.full([x.size(0)], i, dtype=torch.long, device=x.device)
+            latent_z = torch.randn([x.size(0), self.nz], device=x.device)
+            x_0 = self.generator(x, t, latent_z)
+
+            mean = self.posterior_mean_coef1[i] * x_0 + self.posterior_mean_coef2[i] * x
+            noise = torch.randn_like(x)
+            if i > 0:
+                x = mean + torch.exp(0.5 * self.posterior_log_variance_clipped[i]) * noise
+            else:
+                x = mean
+        return x
+
+def export(args):
+    from test_ddgan import load_generator, Posterior_Coefficients
+
+    netG = load_generator(args, args.device)
+    pos_coeff = Posterior_Coefficients(args, args.device)
+
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    x = torch.randn(args.batch_size, args.num_channels, args.image_size, args.image_size,
+                    device=args.device).contiguous(memory_format=memory_format)
+    t = torch.zeros(args.batch_size, dtype=torch.long, device=args.device)
+    latent_z = torch.randn(args.batch_size, args.nz, device=args.device)
+    with torch.no_grad():
+        generator = torch.jit.trace(netG, (x, t, latent_z))
+
+    sampler = torch.jit.script(Sampler(generator, pos_coeff, args).to(args.device))
+    sampler.save(args.output)
+    print('Saved sampler for batches of {} {}x{} images to {}'.format(
+        args.batch_size, args.image_size, args.image_size, args.output))
+
+def sample(args):
+    import torchvision
+
+    torch.manual_seed(args.seed)
+    sampler = torch.jit.load(args.sampler, map_location=args.device)
+    x_t_1 = torch.randn(sampler.batch_size, sampler.num_channels, sampler.image_size, sampler.image_size,
+                        device=args.device)
+    with torch.no_grad():
+        fake_sample = sampler(x_t_1)
+    torchvision.utils.save_image((fake_sample + 1.) / 2., args.output)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        from test_ddgan import get_parser
+        parser = get_parser()
+        parser.add_argument('--device', default='cpu', help='device the generator is traced on')
+        parser.add_argument('--output', default='sampler.pt')
+        args = parser.parse_args(sys.argv[2:])
+        export(args)
+    else:
+        parser = argparse.ArgumentParser('ddgan sampler parameters')
+        parser.add_argument('command', choices=['sample'])
+        parser.add_argument('--sampler', default='sampler.pt', help='file written by the export command')
+        parser.add_argument('--device', default='cpu')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', default='samples.jpg')
+        args = parser.parse_args()
+        sample(args)
@@ -0,0 +1,234 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import argparse
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+
+from score_sde.models import layerspp
+from score_sde.models.ncsnpp_generator_adagn import NCSNpp
+from score_sde.models.discriminator import Discriminator_small, Discriminator_large
+from test_ddgan import get_parser, load_generator, get_time_schedule, Posterior_Coefficients, \
+    sample_posterior, sample_batch, compute_fid, measure_throughput
+
+# NCSNpp arguments that a pruned checkpoint stores next to its weights.
+MODEL_KEYS = ['num_channels', 'image_size', 'centered', 'num_channels_dae', 'n_mlp', 'ch_mult',
+              'num_res_blocks', 'attn_resolutions', 'dropout', 'resamp_with_conv', 'conditional',
+              'fir', 'fir_kernel', 'skip_rescale', 'resblock_type', 'progressive',
+              'progressive_input', 'progressive_combine', 'embedding_type', 'fourier_scale',
+              'not_use_tanh', 'nz', 'z_emb_dim']
+
+#%% channel scoring
+def score_channels(netG, pos_coeff, T, args, device):
+    """Score the inner channels of every BigGAN resnet block and attention block of `netG`.
+
+    A channel scores its mean absolute activation, accumulated over `args.calib_batches`
+    sampled batches, times the norm of the weights that read it (Conv_1 for resnet blocks,
+    NIN_3 for attention values). Attention queries and keys score |q| * |k| jointly.
+    Returns a dict from the index of the block in `netG.all_modules` to its scores.
+    """
+    scores = {}
+
+    def resblock_hook(conv, inputs, output, i):
+        score = inputs[0].abs().mean((0, 2, 3)) * conv.weight.transpose(0, 1).flatten(1).norm(dim=1)
+        scores[i] = scores.get(i, 0) + score
+
+    def qkv_hook(nin, inputs, output, i):
+        q, k, _ = output.abs().mean((0, 2, 3)).chunk(3)
+        qk, v = scores.get(i, (0, 0))
+        scores[i] = (qk + q * k, v)
+
+    def v_hook(nin, inputs, output, i):
+        score = inputs[0].abs().mean((0, 2, 3)) * nin.W.norm(dim=1)
+        qk, v = scores.get(i, (0, 0))
+        scores[i] = (qk, v + score)
+
+    handles = []
+    for i, module in enumerate(netG.all_modules):
+        if isinstance(module, layerspp.ResnetBlockBigGANpp_Adagn):
+            handles.append(module.Conv_1.register_forward_hook(
+                lambda m, inp, out, i=i: resblock_hook(m, inp, out, i)))
+        elif isinstance(module, layerspp.AttnBlockpp):
+            handles.append(module.NIN_qkv.register_forward_hook(
+                lambda m, inp, out, i=i: qkv_hook(m, inp, out, i)))
+            handles.append(module.NIN_3.register_forward_hook(
+                lambda m, inp, out, i=i: v_hook(m, inp, out, i)))
+
+    for _ in range(args.calib_batches):
+        sample_batch(netG, pos_coeff, T, args, device)
+
+    for handle in handles:
+        handle.remove()
+    return scores
+
+def _top(score, n):
+    return torch.topk(score, n).indices.sort().values
+
+#%% pruning
+def prune_generator(netG, scores, keep_ratio):
+    """Return a smaller NCSNpp holding the highest scoring channels of `netG`, and its config.
+
+    Resnet blocks are pruned in whole GroupNorm_1 groups, so the statistics of the kept
+    groups, and hence the block outputs for the kept channels, are unchanged. Only the
+    'biggan' resnet blocks and the attention blocks are pruned; other resnet blocks
+    keep their width.
+    """
+    config = argparse.Namespace(**vars(netG.config))
+    config.resblock_hidden_ch, config.attn_hidden_ch = [], []
+    state = netG.state_dict()
+
+    for i, module in enumerate(netG.all_modules):
+        prefix = 'all_modules.{}.'.format(i)
+        if isinstance(module, layerspp.ResnetBlockBigGANpp_Adagn):
+            hidden = module.Conv_0.out_channels
+            groups = module.GroupNorm_1.norm.num_groups
+            group_size = hidden // groups
+            n_keep = max(1, int(round(groups * keep_ratio)))
+            kept = _top(scores[i].view(groups, group_size).sum(1), n_keep)
+            idx = (kept[:, None] * group_size + torch.arange(group_size, device=kept.device)).flatten()
+
+            for name in ['Conv_0.weight', 'Conv_0.bias', 'Dense_0.weight', 'Dense_0.bias']:
+                if prefix + name in state:
+                    state[prefix + name] = state[prefix + name][idx]
+            style_idx = torch.cat([idx, idx + hidden])
+            for name in ['GroupNorm_1.style.weight', 'GroupNorm_1.style.bias']:
+                state[prefix + name] = state[prefix + name][style_idx]
+            state[prefix + 'Conv_1.weight'] = state[prefix + 'Conv_1.weight'][:, idx]
+            config.resblock_hidden_ch.append([len(idx), n_keep])
+
+        elif isinstance(module, layerspp.AttnBlockpp):
+            hidden = module.hidden_ch
+            n_keep = max(1, int(round(hidden * keep_ratio)))
+            qk_score, v_score = scores[i]
+            qk_idx, v_idx = _top(qk_score, n_keep), _top(v_score, n_keep)
+            qkv_idx = torch.cat([qk_idx, qk_idx + hidden, v_idx + 2 * hidden])
+
+            state[prefix + 'NIN_qkv.W'] = state[prefix + 'NIN_qkv.W'][:, qkv_idx]
+            state[prefix + 'NIN_qkv.b'] = state[prefix + 'NIN_qkv.b'][qkv_idx]
+            state[prefix + 'NIN_3.W'] = state[prefix + 'NIN_3.W'][v_idx]
+            config.attn_hidden_ch.append(n_keep)
+
+    # NCSNpp only takes widths for 'biggan' resnet blocks; the others keep theirs
+    config.resblock_hidden_ch = config.resblock_hidden_ch or None
+
+    pruned = NCSNpp(config).to(next(netG.parameters()).device)
+    pruned.load_state_dict(state)
+    return pruned, config
+
+#%% fine-tuning
+def load_discriminator(args, device):
+    content = torch.load(os.path.join('./saved_info/dd_gan', args.dataset, args.exp, 'content.pth'),
+                         map_location=device)
+    if args.dataset == 'cifar10' or args.dataset == 'stackmnist':
+        netD = Discriminator_small(nc = 2*args.num_channels, ngf = args.ngf,
+                                   t_emb_dim = args.t_emb_dim, act=nn.LeakyReLU(0.2))
+    else:
+        netD = Discriminator_large(nc = 2*args.num_channels, ngf = args.ngf,
+                                   t_emb_dim = args.t_emb_dim, act=nn.LeakyReLU(0.2))
+    #loading weights from ddp
+    netD.load_state_dict({key[7:]: value for key, value in content['netD_dict'].items()})
+    return netD.to(device)
+
+def finetune(netG_pruned, netG, netD, pos_coeff, args, device):
+    """Train `netG_pruned` to match `netG` on `netG`'s own sampling trajectories.
+
+    The loss is the squared error between the x_0 predictions of both generators plus
+    `args.adv_weight` times the usual non-saturating G loss under the frozen `netD`.
+    """
+    for p in netD.parameters():
+        p.requires_grad = False
+    optimizer = optim.Adam(netG_pruned.parameters(), lr=args.lr_g, betas=(args.beta1, args.beta2))
+    netG_pruned.train()
+
+    for iteration in range(args.finetune_iters):
+        # x_{t+1} for every step of a chain sampled by the original generator.
+        with torch.no_grad():
+            x = torch.randn(args.batch_size, args.num_channels, args.image_size, args.image_size, device=device)
+            x_tp1, ts = [], []
+            for i in reversed(range(args.num_timesteps)):
+                t = torch.full((x.size(0),), i, dtype=torch.int64, device=device)
+                x_tp1.append(x)
+                ts.append(t)
+                latent_z = torch.randn(x.size(0), args.nz, device=device)
+                x = sample_posterior(pos_coeff, netG(x, t, latent_z), x, t)
+            x_tp1, t = torch.cat(x_tp1), torch.cat(ts)
+            latent_z = torch.randn(x_tp1.size(0), args.nz, device=device)
+            x_0_target = netG(x_tp1, t, latent_z)
+
+        x_0_predict = netG_pruned(x_tp1, t, latent_z)
+        x_pos_sample = sample_posterior(pos_coeff, x_0_predict, x_tp1, t)
+        output = netD(x_pos_sample, t, x_tp1).view(-1)
+
+        err_distill = F.mse_loss(x_0_predict, x_0_target)
+        err_adv = F.softplus(-output).mean()
+
+        optimizer.zero_grad()
+        (err_distill + args.adv_weight * err_adv).backward()
+        optimizer.step()
+
+        if iteration % 100 == 0:
+            print('finetune iteration {}, distill loss: {}, G loss: {}'.format(
+                iteration, err_distill.item(), err_adv.item()))
+
+    netG_pruned.eval()
+
+#%%
+def prune(args):
+    torch.manual_seed(args.seed)
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+
+    netG = load_generator(args, device)
+    T = get_time_schedule(args, device)
+    pos_coeff = Posterior_Coefficients(args, device)
+
+    scores = score_channels(netG, pos_coeff, T, args, device)
+    netG_pruned, config = prune_generator(netG, scores, args.keep_ratio)
+
+    if args.finetune_iters > 0:
+        netD = load_discriminator(args, device)
+        finetune(netG_pruned, netG, netD, pos_coeff, args, device)
+
+    output = args.output
+    if output is None:
+        output = './saved_info/dd_gan/{}/{}/netG_{}_pruned.pth'.format(args.dataset, args.exp, args.epoch_id)
+    torch.save({'config': {key: getattr(config, key) for key in MODEL_KEYS + ['resblock_hidden_ch', 'attn_hidden_ch']},
+                'netG_dict': netG_pruned.state_dict()}, output)
+    print('Saved pruned generator to {}'.format(output))
+
+    for name, model in [('original', netG), ('pruned', netG_pruned)]:
+        num_params = sum(p.numel() for p in model.parameters())
+        print('{}: {} parameters, {:.2f} images/s'.format(
+            name, num_params, measure_throughput(model, pos_coeff, T, args, device)))
+        if args.compute_fid:
+            save_dir = './generated_samples/{}_{}'.format(args.dataset, name)
+            print('{}: FID = {}'.format(name, compute_fid(model, pos_coeff, T, args, device, save_dir)))
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--keep_ratio', type=float, default=0.75,
+                        help='fraction of channels kept in every resnet and attention block')
+    parser.add_argument('--calib_batches', type=int, default=4,
+                        help='number of sampled batches used to score channels')
+    parser.add_argument('--output', default=None, help='where to save the pruned generator')
+
+    parser.add_argument('--finetune_iters', type=int, default=0,
+                        help='fine-tune the pruned generator against the original for this many iterations')
+    parser.add_argument('--adv_weight', type=float, default=0.1, help='weight of the G loss from D when fine-tuning')
+    parser.add_argument('--ngf', type=int, default=64)
+    parser.add_argument('--lr_g', type=float, default=1.6e-5, help='learning rate for fine-tuning')
+    parser.add_argument('--beta1', type=float, default=0.5,
+                            help='beta1 for adam')
+    parser.add_argument('--beta2', type=float, default=0.9,
+                            help='beta2 for adam')
+
+    args = parser.parse_args()
+
+    prune(args)
@@ -0,0 +1,87 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import copy
+
+import torch
+import torch.nn as nn
+
+from test_ddgan import get_parser, load_generator, get_time_schedule, Posterior_Coefficients, \
+    sample_batch, compute_fid, measure_throughput
+
+
+def _wrap_layers(module, qconfig):
+    # Every conv and linear layer runs in int8 between its own quantize/dequantize pair,
+    # so the GroupNorms, activations and skip connections in between stay in float.
+    for name, child in module.named_children():
+        if isinstance(child, (nn.Conv2d, nn.Linear)):
+            wrapper = torch.quantization.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_layers(child, qconfig)
+
+def quantize_generator(netG, pos_coeff, T, args, backend='fbgemm'):
+    """Return an int8 copy of `netG` for CPU sampling.
+
+    The nn.Conv2d and nn.Linear layers, including the z_transform mapping network, are
+    quantized with static post-training quantization, calibrated on `args.calib_batches`
+    batches from sample_from_model. The FIR resampling convs and the attention NINs use
+    functional ops and stay in float, and so do the fused up blocks of --fused_resample,
+    which fall back to their unfused path around the wrapped convs.
+    """
+    if args.conditional and args.embedding_type == 'fourier':
+        raise ValueError('the fourier embedding takes log(t), which is -inf at t = 0, '
+                         'so its activation ranges cannot be calibrated')
+    torch.backends.quantized.engine = backend
+    qnetG = copy.deepcopy(netG).cpu().eval()
+    _wrap_layers(qnetG, torch.quantization.get_default_qconfig(backend))
+    torch.quantization.prepare(qnetG, inplace=True)
+
+    for _ in range(args.calib_batches):
+        sample_batch(qnetG, pos_coeff, T, args, 'cpu')
+
+    torch.quantization.convert(qnetG, inplace=True)
+    return qnetG
+
+#%%
+def quantize_and_test(args):
+    torch.manual_seed(args.seed)
+    device = 'cpu'
+
+    netG = load_generator(args, device)
+    T = get_time_schedule(args, device)
+    pos_coeff = Posterior_Coefficients(args, device)
+
+    qnetG = quantize_generator(netG, pos_coeff, T, args, args.backend)
+
+    results = {}
+    for name, model in [('fp32', netG), ('int8', qnetG)]:
+        throughput = measure_throughput(model, pos_coeff, T, args, device)
+        print('{}: {:.2f} images/s with {} threads'.format(name, throughput, torch.get_num_threads()))
+        results[name] = [throughput]
+        if args.compute_fid:
+            save_dir = './generated_samples/{}_{}'.format(args.dataset, name)
+            fid = compute_fid(model, pos_coeff, T, args, device, save_dir, args.num_fid_samples)
+            print('{}: FID = {}'.format(name, fid))
+            results[name].append(fid)
+
+    print('int8 speedup: {:.2f}x'.format(results['int8'][0] / results['fp32'][0]))
+    if args.compute_fid:
+        print('int8 FID change: {:+.3f}'.format(results['int8'][1] - results['fp32'][1]))
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--calib_batches', type=int, default=4,
+                        help='number of sampled batches used to calibrate activation ranges')
+    parser.add_argument('--backend', default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                        help='quantized engine, fbgemm for x86 and qnnpack for ARM')
+    parser.add_argument('--num_fid_samples', type=int, default=50000)
+
+    args = parser.parse_args()
+
+    quantize_and_test(args)
@@ -52,6 +52,8 @@ class DownConvBlock(nn.Module):
         
         self.fir_kernel = fir_kernel
         self.downsample = downsample
+        if downsample:
+            self.fir_downsample = up_or_down_sampling.Downsample2d(fir_kernel, factor=2)
         
         self.conv1 = nn.Sequential(
                     conv2d(in_channel, out_channel, kernel_size, padding=padding),
@@ -82,8 +84,8 @@ class DownConvBlock(nn.Module):
         out = self.act(out)
        
         if self.downsample:
-            out = up_or_down_sampling.downsample_2d(out, self.fir_kernel, factor=2)
-            input = up_or_down_sampling.downsample_2d(input, self.fir_kernel, factor=2)
+            out = self.fir_downsample(out)
+            input = self.fir_downsample(input)
         out = self.conv2(out)
         
         
@@ -93,6 +95,28 @@ class DownConvBlock(nn.Module):
 
         return out
     
+
+def minibatch_stddev(out, group_size, num_feat, num_splits=1):
+  """Append the minibatch standard deviation of `out` as extra feature maps.
+
+  The batch is made of `num_splits` equal, consecutive parts (e.g. real samples then
+  fake ones) and stddev groups never mix samples from different parts, so each part
+  gets the same statistics as if it were passed through D on its own.
+  """
+  batch, channel, height, width = out.shape
+  group = min(batch // num_splits, group_size)
+  stddev = out.view(
+          num_splits, group, -1, num_feat, channel // num_feat, height, width
+      )
+  stddev = torch.sqrt(stddev.var(1, unbiased=False) + 1e-8)
+  stddev = stddev.mean([3, 4, 5], keepdims=True).squeeze(3)
+  stddev = stddev.unsqueeze(1).repeat(1, group, 1, 1, height, width).view(batch, num_feat, height, width)
+  if out.is_contiguous(memory_format=torch.channels_last):
+    # Otherwise the concatenation falls back to a contiguous NCHW copy.
+    stddev = stddev.to(memory_format=torch.channels_last)
+  return torch.cat([out, stddev], 1)
+
+
 class Discriminator_small(nn.Module):
   """A time-dependent discriminator for small images (CIFAR10, StackMNIST)."""
 
@@ -131,7 +155,7 @@ class Discriminator_small(nn.Module):
     self.stddev_feat = 1
     
         
-  def forward(self, x, t, x_t):
+  def forward(self, x, t, x_t, num_splits=1):
     t_embed = self.act(self.t_embed(t))  
     
   
@@ -147,15 +171,7 @@ class Discriminator_small(nn.Module):
     
     out = self.conv4(h3,t_embed)
     
-    batch, channel, height, width = out.shape
-    group = min(batch, self.stddev_group)
-    stddev = out.view(
-            group, -1, self.stddev_feat, channel // self.stddev_feat, height, width
-        )
-    stddev = torch.sqrt(stddev.var(0, unbiased=False) + 1e-8)
-    stddev = stddev.mean([2, 3, 4], keepdims=True).squeeze(2)
-    stddev = stddev.repeat(group, 1, height, width)
-    out = torch.cat([out, stddev], 1)
+    out = minibatch_stddev(out, self.stddev_group, self.stddev_feat, num_splits)
     
     out = self.final_conv(out)
     out = self.act(out)
@@ -202,7 +218,7 @@ class Discriminator_large(nn.Module):
     self.stddev_feat = 1
     
         
-  def forward(self, x, t, x_t):
+  def forward(self, x, t, x_t, num_splits=1):
     t_embed = self.act(self.t_embed(t))  
     
     input_x = torch.cat((x, x_t), dim = 1)
@@ -219,15 +235,7 @@ class Discriminator_large(nn.Module):
     
     out = self.conv6(h,t_embed)
     
-    batch, channel, height, width = out.shape
-    group = min(batch, self.stddev_group)
-    stddev = out.view(
-            group, -1, self.stddev_feat, channel // self.stddev_feat, height, width
-        )
-    stddev = torch.sqrt(stddev.var(0, unbiased=False) + 1e-8)
-    stddev = stddev.mean([2, 3, 4], keepdims=True).squeeze(2)
-    stddev = stddev.repeat(group, 1, height, width)
-    out = torch.cat([out, stddev], 1)
+    out = minibatch_stddev(out, self.stddev_group, self.stddev_feat, num_splits)
     
     out = self.final_conv(out)
     out = self.act(out)
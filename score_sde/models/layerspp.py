@@ -31,6 +31,7 @@
 
 from . import layers
 from . import up_or_down_sampling, dense_layer
+from ..op import fused_adaptive_group_norm
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
@@ -43,8 +44,28 @@ NIN = layers.NIN
 default_init = layers.default_init
 dense = dense_layer.dense
 
+
+def residual_add(x, h, skip_rescale=False):
+  """Return `x + h`, divided by sqrt(2) if `skip_rescale`.
+
+  When autograd is off, the sum is written into `h`, which must be a fresh tensor owned by the caller.
+  """
+  if torch.is_grad_enabled():
+    return (x + h) / np.sqrt(2.) if skip_rescale else x + h
+  h += x
+  if skip_rescale:
+    h /= np.sqrt(2.)
+  return h
+
+
+def fresh_act(act, h):
+  """Return `act(h)`; when autograd is off and `act` is a SiLU, in place on `h`, a fresh tensor owned by the caller."""
+  if torch.is_grad_enabled() or not isinstance(act, nn.SiLU):
+    return act(h)
+  return F.silu(h, inplace=True)
+
 class AdaptiveGroupNorm(nn.Module):
-    def __init__(self, num_groups,in_channel, style_dim):
+    def __init__(self, num_groups,in_channel, style_dim, fused=False):
         super().__init__()
 
         self.norm = nn.GroupNorm(num_groups, in_channel, affine=False, eps=1e-6)
@@ -52,15 +73,27 @@ class AdaptiveGroupNorm(nn.Module):
 
         self.style.bias.data[:in_channel] = 1
         self.style.bias.data[in_channel:] = 0
+        self.fused = fused
+
+    def forward(self, input, style, act=None):
+        # TorchScript cannot serialize the autograd Function, so traced or scripted
+        # models take the equivalent GroupNorm path below.
+        jit = torch.jit.is_tracing() or torch.jit.is_scripting()
+        if self.fused and not jit and (act is None or isinstance(act, nn.SiLU)):
+            gamma, beta = self.style(style).chunk(2, 1)
+            return fused_adaptive_group_norm(input, gamma, beta, self.norm.num_groups, self.norm.eps,
+                                             silu=act is not None)
 
-    def forward(self, input, style):
         style = self.style(style).unsqueeze(2).unsqueeze(3)
         gamma, beta = style.chunk(2, 1)
 
         out = self.norm(input)
-        out = gamma * out + beta
+        if torch.is_grad_enabled():
+            out = gamma * out + beta
+        else:
+            out = out.mul_(gamma).add_(beta)
 
-        return out
+        return out if act is None else fresh_act(act, out)
 
 class GaussianFourierProjection(nn.Module):
   """Gaussian Fourier embeddings for noise levels."""
@@ -95,33 +128,46 @@ class Combine(nn.Module):
 class AttnBlockpp(nn.Module):
   """Channel-wise self-attention block. Modified from DDPM."""
 
-  def __init__(self, channels, skip_rescale=False, init_scale=0.):
+  def __init__(self, channels, skip_rescale=False, init_scale=0., hidden_ch=None):
     super().__init__()
+    # Width of q, k and v; smaller than `channels` only in pruned models.
+    hidden_ch = hidden_ch if hidden_ch else channels
     self.GroupNorm_0 = nn.GroupNorm(num_groups=min(channels // 4, 32), num_channels=channels,
                                   eps=1e-6)
-    self.NIN_0 = NIN(channels, channels)
-    self.NIN_1 = NIN(channels, channels)
-    self.NIN_2 = NIN(channels, channels)
-    self.NIN_3 = NIN(channels, channels, init_scale=init_scale)
+    # q, k and v projections fused into a single NIN, initialized as three separate ones.
+    self.NIN_qkv = NIN(channels, 3 * hidden_ch)
+    self.NIN_qkv.W.data = torch.cat([default_init(scale=0.1)((channels, hidden_ch)) for _ in range(3)], dim=1)
+    self.NIN_3 = NIN(hidden_ch, channels, init_scale=init_scale)
     self.skip_rescale = skip_rescale
+    self.hidden_ch = hidden_ch
+
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    # Checkpoints saved before the fusion store q, k and v in NIN_0, NIN_1 and NIN_2.
+    if prefix + 'NIN_0.W' in state_dict:
+      for name in ('W', 'b'):
+        state_dict[prefix + 'NIN_qkv.' + name] = torch.cat(
+          [state_dict.pop(prefix + 'NIN_{}.{}'.format(i, name)) for i in range(3)], dim=-1)
+    super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
   def forward(self, x):
     B, C, H, W = x.shape
+    D = self.hidden_ch
     h = self.GroupNorm_0(x)
-    q = self.NIN_0(h)
-    k = self.NIN_1(h)
-    v = self.NIN_2(h)
-
-    w = torch.einsum('bchw,bcij->bhwij', q, k) * (int(C) ** (-0.5))
-    w = torch.reshape(w, (B, H, W, H * W))
-    w = F.softmax(w, dim=-1)
-    w = torch.reshape(w, (B, H, W, H, W))
-    h = torch.einsum('bhwij,bcij->bchw', w, v)
-    h = self.NIN_3(h)
-    if not self.skip_rescale:
-      return x + h
+    qkv = self.NIN_qkv(h)
+
+    if qkv.is_contiguous(memory_format=torch.channels_last):
+      # (B, H*W, D) views of a channels_last tensor need no copy.
+      q, k, v = qkv.permute(0, 2, 3, 1).reshape(B, H * W, 3 * D).chunk(3, dim=2)
+      w = torch.bmm(q, k.transpose(1, 2)) * (int(C) ** (-0.5))
+      w = F.softmax(w, dim=-1)
+      h = torch.bmm(w, v).reshape(B, H, W, D).permute(0, 3, 1, 2)
     else:
-      return (x + h) / np.sqrt(2.)
+      q, k, v = qkv.reshape(B, 3, D, H * W).unbind(1)
+      w = torch.bmm(q.transpose(1, 2), k) * (int(C) ** (-0.5))
+      w = F.softmax(w, dim=-1)
+      h = torch.bmm(v, w.transpose(1, 2)).reshape(B, D, H, W)
+    h = self.NIN_3(h)
+    return residual_add(x, h, self.skip_rescale)
 
 
 class Upsample(nn.Module):
@@ -133,7 +179,9 @@ class Upsample(nn.Module):
       if with_conv:
         self.Conv_0 = conv3x3(in_ch, out_ch)
     else:
-      if with_conv:
+      if not with_conv:
+        self.Upsample2d_0 = up_or_down_sampling.Upsample2d(fir_kernel, factor=2)
+      else:
         self.Conv2d_0 = up_or_down_sampling.Conv2d(in_ch, out_ch,
                                                    kernel=3, up=True,
                                                    resample_kernel=fir_kernel,
@@ -152,7 +200,7 @@ class Upsample(nn.Module):
         h = self.Conv_0(h)
     else:
       if not self.with_conv:
-        h = up_or_down_sampling.upsample_2d(x, self.fir_kernel, factor=2)
+        h = self.Upsample2d_0(x)
       else:
         h = self.Conv2d_0(x)
 
@@ -168,7 +216,9 @@ class Downsample(nn.Module):
       if with_conv:
         self.Conv_0 = conv3x3(in_ch, out_ch, stride=2, padding=0)
     else:
-      if with_conv:
+      if not with_conv:
+        self.Downsample2d_0 = up_or_down_sampling.Downsample2d(fir_kernel, factor=2)
+      else:
         self.Conv2d_0 = up_or_down_sampling.Conv2d(in_ch, out_ch,
                                                    kernel=3, down=True,
                                                    resample_kernel=fir_kernel,
@@ -189,7 +239,7 @@ class Downsample(nn.Module):
         x = F.avg_pool2d(x, 2, stride=2)
     else:
       if not self.with_conv:
-        x = up_or_down_sampling.downsample_2d(x, self.fir_kernel, factor=2)
+        x = self.Downsample2d_0(x)
       else:
         x = self.Conv2d_0(x)
 
@@ -200,10 +250,10 @@ class ResnetBlockDDPMpp_Adagn(nn.Module):
   """ResBlock adapted from DDPM."""
 
   def __init__(self, act, in_ch, out_ch=None, temb_dim=None, zemb_dim=None, conv_shortcut=False,
-               dropout=0.1, skip_rescale=False, init_scale=0.):
+               dropout=0.1, skip_rescale=False, init_scale=0., fused_norm=False):
     super().__init__()
     out_ch = out_ch if out_ch else in_ch
-    self.GroupNorm_0 = AdaptiveGroupNorm(min(in_ch // 4, 32), in_ch, zemb_dim)
+    self.GroupNorm_0 = AdaptiveGroupNorm(min(in_ch // 4, 32), in_ch, zemb_dim, fused=fused_norm)
     self.Conv_0 = conv3x3(in_ch, out_ch)
     if temb_dim is not None:
       self.Dense_0 = nn.Linear(temb_dim, out_ch)
@@ -211,7 +261,7 @@ class ResnetBlockDDPMpp_Adagn(nn.Module):
       nn.init.zeros_(self.Dense_0.bias)
       
       
-    self.GroupNorm_1 = AdaptiveGroupNorm(min(out_ch // 4, 32), out_ch, zemb_dim)
+    self.GroupNorm_1 = AdaptiveGroupNorm(min(out_ch // 4, 32), out_ch, zemb_dim, fused=fused_norm)
     self.Dropout_0 = nn.Dropout(dropout)
     self.Conv_1 = conv3x3(out_ch, out_ch, init_scale=init_scale)
     if in_ch != out_ch:
@@ -226,11 +276,11 @@ class ResnetBlockDDPMpp_Adagn(nn.Module):
     self.conv_shortcut = conv_shortcut
 
   def forward(self, x, temb=None, zemb=None):
-    h = self.act(self.GroupNorm_0(x, zemb))
+    h = self.GroupNorm_0(x, zemb, act=self.act)
     h = self.Conv_0(h)
     if temb is not None:
       h += self.Dense_0(self.act(temb))[:, :, None, None]
-    h = self.act(self.GroupNorm_1(h, zemb))
+    h = self.GroupNorm_1(h, zemb, act=self.act)
     h = self.Dropout_0(h)
     h = self.Conv_1(h)
     if x.shape[1] != self.out_ch:
@@ -238,35 +288,43 @@ class ResnetBlockDDPMpp_Adagn(nn.Module):
         x = self.Conv_2(x)
       else:
         x = self.NIN_0(x)
-    if not self.skip_rescale:
-      return x + h
-    else:
-      return (x + h) / np.sqrt(2.)
+    return residual_add(x, h, self.skip_rescale)
 
 
 class ResnetBlockBigGANpp_Adagn(nn.Module):
   def __init__(self, act, in_ch, out_ch=None, temb_dim=None, zemb_dim=None, up=False, down=False,
                dropout=0.1, fir=False, fir_kernel=(1, 3, 3, 1),
-               skip_rescale=True, init_scale=0.):
+               skip_rescale=True, init_scale=0., hidden_ch=None, hidden_groups=None, fused_norm=False,
+               fused_resample=False):
     super().__init__()
 
     out_ch = out_ch if out_ch else in_ch
-    self.GroupNorm_0 = AdaptiveGroupNorm(min(in_ch // 4, 32), in_ch, zemb_dim)
+    # Width between Conv_0 and Conv_1; smaller than out_ch only in pruned models.
+    hidden_ch = hidden_ch if hidden_ch else out_ch
+    hidden_groups = hidden_groups if hidden_groups else min(hidden_ch // 4, 32)
+    self.GroupNorm_0 = AdaptiveGroupNorm(min(in_ch // 4, 32), in_ch, zemb_dim, fused=fused_norm)
     
     self.up = up
     self.down = down
     self.fir = fir
     self.fir_kernel = fir_kernel
-
-    self.Conv_0 = conv3x3(in_ch, out_ch)
+    # Only FIR upsampling is fused: down blocks downsample before Conv_0, so they
+    # never hold a full-resolution intermediate.
+    self.fused_resample = fused_resample and fir and up
+    if fir and up:
+      self.Upsample2d_0 = up_or_down_sampling.Upsample2d(fir_kernel, factor=2)
+    elif fir and down:
+      self.Downsample2d_0 = up_or_down_sampling.Downsample2d(fir_kernel, factor=2)
+
+    self.Conv_0 = conv3x3(in_ch, hidden_ch)
     if temb_dim is not None:
-      self.Dense_0 = nn.Linear(temb_dim, out_ch)
+      self.Dense_0 = nn.Linear(temb_dim, hidden_ch)
       self.Dense_0.weight.data = default_init()(self.Dense_0.weight.shape)
       nn.init.zeros_(self.Dense_0.bias)
    
-    self.GroupNorm_1 = AdaptiveGroupNorm(min(out_ch // 4, 32), out_ch, zemb_dim)
+    self.GroupNorm_1 = AdaptiveGroupNorm(hidden_groups, hidden_ch, zemb_dim, fused=fused_norm)
     self.Dropout_0 = nn.Dropout(dropout)
-    self.Conv_1 = conv3x3(out_ch, out_ch, init_scale=init_scale)
+    self.Conv_1 = conv3x3(hidden_ch, out_ch, init_scale=init_scale)
     if in_ch != out_ch or up or down:
       self.Conv_2 = conv1x1(in_ch, out_ch)
 
@@ -276,53 +334,66 @@ class ResnetBlockBigGANpp_Adagn(nn.Module):
     self.out_ch = out_ch
 
   def forward(self, x, temb=None, zemb=None):
-    h = self.act(self.GroupNorm_0(x, zemb))
-
-    if self.up:
-      if self.fir:
-        h = up_or_down_sampling.upsample_2d(h, self.fir_kernel, factor=2)
-        x = up_or_down_sampling.upsample_2d(x, self.fir_kernel, factor=2)
-      else:
-        h = up_or_down_sampling.naive_upsample_2d(h, factor=2)
-        x = up_or_down_sampling.naive_upsample_2d(x, factor=2)
-    elif self.down:
-      if self.fir:
-        h = up_or_down_sampling.downsample_2d(h, self.fir_kernel, factor=2)
-        x = up_or_down_sampling.downsample_2d(x, self.fir_kernel, factor=2)
-      else:
-        h = up_or_down_sampling.naive_downsample_2d(h, factor=2)
-        x = up_or_down_sampling.naive_downsample_2d(x, factor=2)
-
-    h = self.Conv_0(h)
+    h = self.GroupNorm_0(x, zemb, act=self.act)
+
+    # The fused path reads the conv weights, so convs swapped for other modules, e.g. the
+    # quantization wrappers of quantize_ddgan.py, run unfused.
+    fused_resample = self.fused_resample and type(self.Conv_0) is nn.Conv2d and type(self.Conv_2) is nn.Conv2d
+    if fused_resample:
+      h = self.Upsample2d_0.upsample_conv(h, self.Conv_0.weight) + self.Conv_0.bias[None, :, None, None]
+      # Conv_2 commutes with the per-channel upsampling, so it runs at the input
+      # resolution; only its bias has to wait until after upsampling.
+      x = self.Upsample2d_0(F.conv2d(x, self.Conv_2.weight)) + self.Conv_2.bias[None, :, None, None]
+    else:
+      if self.up:
+        if self.fir:
+          h = self.Upsample2d_0(h)
+          x = self.Upsample2d_0(x)
+        else:
+          h = up_or_down_sampling.naive_upsample_2d(h, factor=2)
+          x = up_or_down_sampling.naive_upsample_2d(x, factor=2)
+      elif self.down:
+        if self.fir:
+          h = self.Downsample2d_0(h)
+          x = self.Downsample2d_0(x)
+        else:
+          h = up_or_down_sampling.naive_downsample_2d(h, factor=2)
+          x = up_or_down_sampling.naive_downsample_2d(x, factor=2)
+
+      h = self.Conv_0(h)
     # Add bias to each feature map conditioned on the time embedding
     if temb is not None:
       h += self.Dense_0(self.act(temb))[:, :, None, None]
-    h = self.act(self.GroupNorm_1(h, zemb))
+    h = self.GroupNorm_1(h, zemb, act=self.act)
     h = self.Dropout_0(h)
     h = self.Conv_1(h)
    
-    if self.in_ch != self.out_ch or self.up or self.down:
+    if (self.in_ch != self.out_ch or self.up or self.down) and not fused_resample:
       x = self.Conv_2(x)
 
-    if not self.skip_rescale:
-      return x + h
-    else:
-      return (x + h) / np.sqrt(2.)
+    return residual_add(x, h, self.skip_rescale)
   
 
 class ResnetBlockBigGANpp_Adagn_one(nn.Module):
   def __init__(self, act, in_ch, out_ch=None, temb_dim=None, zemb_dim=None, up=False, down=False,
                dropout=0.1, fir=False, fir_kernel=(1, 3, 3, 1),
-               skip_rescale=True, init_scale=0.):
+               skip_rescale=True, init_scale=0., fused_norm=False, fused_resample=False):
     super().__init__()
 
     out_ch = out_ch if out_ch else in_ch
-    self.GroupNorm_0 = AdaptiveGroupNorm(min(in_ch // 4, 32), in_ch, zemb_dim)
+    self.GroupNorm_0 = AdaptiveGroupNorm(min(in_ch // 4, 32), in_ch, zemb_dim, fused=fused_norm)
    
     self.up = up
     self.down = down
     self.fir = fir
     self.fir_kernel = fir_kernel
+    # Only FIR upsampling is fused: down blocks downsample before Conv_0, so they
+    # never hold a full-resolution intermediate.
+    self.fused_resample = fused_resample and fir and up
+    if fir and up:
+      self.Upsample2d_0 = up_or_down_sampling.Upsample2d(fir_kernel, factor=2)
+    elif fir and down:
+      self.Downsample2d_0 = up_or_down_sampling.Downsample2d(fir_kernel, factor=2)
 
     self.Conv_0 = conv3x3(in_ch, out_ch)
     if temb_dim is not None:
@@ -344,24 +415,33 @@ class ResnetBlockBigGANpp_Adagn_one(nn.Module):
     self.out_ch = out_ch
 
   def forward(self, x, temb=None, zemb=None):
-    h = self.act(self.GroupNorm_0(x, zemb))
-
-    if self.up:
-      if self.fir:
-        h = up_or_down_sampling.upsample_2d(h, self.fir_kernel, factor=2)
-        x = up_or_down_sampling.upsample_2d(x, self.fir_kernel, factor=2)
-      else:
-        h = up_or_down_sampling.naive_upsample_2d(h, factor=2)
-        x = up_or_down_sampling.naive_upsample_2d(x, factor=2)
-    elif self.down:
-      if self.fir:
-        h = up_or_down_sampling.downsample_2d(h, self.fir_kernel, factor=2)
-        x = up_or_down_sampling.downsample_2d(x, self.fir_kernel, factor=2)
-      else:
-        h = up_or_down_sampling.naive_downsample_2d(h, factor=2)
-        x = up_or_down_sampling.naive_downsample_2d(x, factor=2)
-
-    h = self.Conv_0(h)
+    h = self.GroupNorm_0(x, zemb, act=self.act)
+
+    # The fused path reads the conv weights, so convs swapped for other modules, e.g. the
+    # quantization wrappers of quantize_ddgan.py, run unfused.
+    fused_resample = self.fused_resample and type(self.Conv_0) is nn.Conv2d and type(self.Conv_2) is nn.Conv2d
+    if fused_resample:
+      h = self.Upsample2d_0.upsample_conv(h, self.Conv_0.weight) + self.Conv_0.bias[None, :, None, None]
+      # Conv_2 commutes with the per-channel upsampling, so it runs at the input
+      # resolution; only its bias has to wait until after upsampling.
+      x = self.Upsample2d_0(F.conv2d(x, self.Conv_2.weight)) + self.Conv_2.bias[None, :, None, None]
+    else:
+      if self.up:
+        if self.fir:
+          h = self.Upsample2d_0(h)
+          x = self.Upsample2d_0(x)
+        else:
+          h = up_or_down_sampling.naive_upsample_2d(h, factor=2)
+          x = up_or_down_sampling.naive_upsample_2d(x, factor=2)
+      elif self.down:
+        if self.fir:
+          h = self.Downsample2d_0(h)
+          x = self.Downsample2d_0(x)
+        else:
+          h = up_or_down_sampling.naive_downsample_2d(h, factor=2)
+          x = up_or_down_sampling.naive_downsample_2d(x, factor=2)
+
+      h = self.Conv_0(h)
     # Add bias to each feature map conditioned on the time embedding
     if temb is not None:
       h += self.Dense_0(self.act(temb))[:, :, None, None]
@@ -370,11 +450,8 @@ class ResnetBlockBigGANpp_Adagn_one(nn.Module):
     h = self.Conv_1(h)
     
 
-    if self.in_ch != self.out_ch or self.up or self.down:
+    if (self.in_ch != self.out_ch or self.up or self.down) and not fused_resample:
       x = self.Conv_2(x)
 
-    if not self.skip_rescale:
-      return x + h
-    else:
-      return (x + h) / np.sqrt(2.)
+    return residual_add(x, h, self.skip_rescale)
   
@@ -34,6 +34,7 @@
 from . import utils, layers, layerspp, dense_layer
 import torch.nn as nn
 import functools
+import collections
 import torch
 import numpy as np
 
@@ -48,6 +49,19 @@ get_act = layers.get_act
 default_initializer = layers.default_init
 dense = dense_layer.dense
 
+# One step of the resolved forward pass: `kind` selects the operation and `modules`
+# holds the indices into `NCSNpp.all_modules` it uses.
+Stage = collections.namedtuple('Stage', ['kind', 'modules'])
+
+
+def _with_hidden_ch(block, widths, **kwargs):
+  width = next(widths)
+  if isinstance(width, (list, tuple)):
+    # Resnet blocks: (hidden_ch, hidden_groups).
+    return block(hidden_ch=width[0], hidden_groups=width[1], **kwargs)
+  return block(hidden_ch=width, **kwargs)
+
+
 class PixelNorm(nn.Module):
     def __init__(self):
         super().__init__()
@@ -80,6 +94,8 @@ class NCSNpp(nn.Module):
     fir = config.fir
     fir_kernel = config.fir_kernel
     self.skip_rescale = skip_rescale = config.skip_rescale
+    fused_adagn = getattr(config, 'fused_adagn', False)
+    fused_resample = getattr(config, 'fused_resample', False)
     self.resblock_type = resblock_type = config.resblock_type.lower()
     self.progressive = progressive = config.progressive.lower()
     self.progressive_input = progressive_input = config.progressive_input.lower()
@@ -92,29 +108,40 @@ class NCSNpp(nn.Module):
     combiner = functools.partial(Combine, method=combine_method)
 
     modules = []
+    # Execution plan for forward, resolved once here instead of on every call.
+    plan = []
+
+    def add_stage(kind, *stage_modules):
+      plan.append(Stage(kind, tuple(range(len(modules), len(modules) + len(stage_modules)))))
+      modules.extend(stage_modules)
+
     # timestep/noise_level embedding; only for continuous training
+    # Without conditioning temb stays None; the Fourier projection is still registered
+    # (as an 'unused' stage) so that module indices match conditional checkpoints.
     if embedding_type == 'fourier':
       # Gaussian Fourier features embeddings.
       #assert config.training.continuous, "Fourier features are only used for continuous training."
 
-      modules.append(layerspp.GaussianFourierProjection(
+      add_stage('embed_fourier' if conditional else 'unused', layerspp.GaussianFourierProjection(
         embedding_size=nf, scale=config.fourier_scale
       ))
       embed_dim = 2 * nf
 
     elif embedding_type == 'positional':
+      if conditional:
+        add_stage('embed_positional')
       embed_dim = nf
 
     else:
       raise ValueError(f'embedding type {embedding_type} unknown.')
 
     if conditional:
-      modules.append(nn.Linear(embed_dim, nf * 4))
-      modules[-1].weight.data = default_initializer()(modules[-1].weight.shape)
-      nn.init.zeros_(modules[-1].bias)
-      modules.append(nn.Linear(nf * 4, nf * 4))
-      modules[-1].weight.data = default_initializer()(modules[-1].weight.shape)
-      nn.init.zeros_(modules[-1].bias)
+      temb_dense = []
+      for dim in (embed_dim, nf * 4):
+        temb_dense.append(nn.Linear(dim, nf * 4))
+        temb_dense[-1].weight.data = default_initializer()(temb_dense[-1].weight.shape)
+        nn.init.zeros_(temb_dense[-1].bias)
+      add_stage('temb', *temb_dense)
 
     AttnBlock = functools.partial(layerspp.AttnBlockpp,
                                   init_scale=init_scale,
@@ -145,7 +172,8 @@ class NCSNpp(nn.Module):
                                       init_scale=init_scale,
                                       skip_rescale=skip_rescale,
                                       temb_dim=nf * 4,
-                                      zemb_dim = z_emb_dim)
+                                      zemb_dim = z_emb_dim,
+                                      fused_norm=fused_adagn)
 
     elif resblock_type == 'biggan':
       ResnetBlock = functools.partial(ResnetBlockBigGAN,
@@ -156,7 +184,9 @@ class NCSNpp(nn.Module):
                                       init_scale=init_scale,
                                       skip_rescale=skip_rescale,
                                       temb_dim=nf * 4,
-                                      zemb_dim = z_emb_dim)
+                                      zemb_dim = z_emb_dim,
+                                      fused_norm=fused_adagn,
+                                      fused_resample=fused_resample)
     elif resblock_type == 'biggan_oneadagn':
       ResnetBlock = functools.partial(ResnetBlockBigGAN_one,
                                       act=act,
@@ -166,18 +196,32 @@ class NCSNpp(nn.Module):
                                       init_scale=init_scale,
                                       skip_rescale=skip_rescale,
                                       temb_dim=nf * 4,
-                                      zemb_dim = z_emb_dim)
+                                      zemb_dim = z_emb_dim,
+                                      fused_norm=fused_adagn,
+                                      fused_resample=fused_resample)
 
     else:
       raise ValueError(f'resblock type {resblock_type} unrecognized.')
 
+    # Pruned models list the inner widths of every resnet and attention block, in
+    # construction order (see prune_ddgan.py).
+    resblock_hidden_ch = getattr(config, 'resblock_hidden_ch', None)
+    if resblock_hidden_ch is not None:
+      resblock_hidden_ch = iter(resblock_hidden_ch)
+      ResnetBlock = functools.partial(_with_hidden_ch, ResnetBlock, resblock_hidden_ch)
+    attn_hidden_ch = getattr(config, 'attn_hidden_ch', None)
+    if attn_hidden_ch is not None:
+      attn_hidden_ch = iter(attn_hidden_ch)
+      AttnBlock = functools.partial(_with_hidden_ch, AttnBlock, attn_hidden_ch)
+
     # Downsampling block
 
     channels = config.num_channels
     if progressive_input != 'none':
       input_pyramid_ch = channels
 
-    modules.append(conv3x3(channels, nf))
+    add_stage('conv', conv3x3(channels, nf))
+    add_stage('push')
     hs_c = [nf]
 
     in_ch = nf
@@ -185,87 +229,100 @@ class NCSNpp(nn.Module):
       # Residual blocks for this resolution
       for i_block in range(num_res_blocks):
         out_ch = nf * ch_mult[i_level]
-        modules.append(ResnetBlock(in_ch=in_ch, out_ch=out_ch))
+        add_stage('res', ResnetBlock(in_ch=in_ch, out_ch=out_ch))
         in_ch = out_ch
 
         if all_resolutions[i_level] in attn_resolutions:
-          modules.append(AttnBlock(channels=in_ch))
+          add_stage('conv', AttnBlock(channels=in_ch))
+        add_stage('push')
         hs_c.append(in_ch)
 
       if i_level != num_resolutions - 1:
         if resblock_type == 'ddpm':
-          modules.append(Downsample(in_ch=in_ch))
+          add_stage('conv', Downsample(in_ch=in_ch))
         else:
-          modules.append(ResnetBlock(down=True, in_ch=in_ch))
+          add_stage('res', ResnetBlock(down=True, in_ch=in_ch))
 
         if progressive_input == 'input_skip':
-          modules.append(combiner(dim1=input_pyramid_ch, dim2=in_ch))
+          add_stage('input_skip', combiner(dim1=input_pyramid_ch, dim2=in_ch))
           if combine_method == 'cat':
             in_ch *= 2
 
         elif progressive_input == 'residual':
-          modules.append(pyramid_downsample(in_ch=input_pyramid_ch, out_ch=in_ch))
+          add_stage('input_residual', pyramid_downsample(in_ch=input_pyramid_ch, out_ch=in_ch))
           input_pyramid_ch = in_ch
 
+        add_stage('push')
         hs_c.append(in_ch)
 
     in_ch = hs_c[-1]
-    modules.append(ResnetBlock(in_ch=in_ch))
-    modules.append(AttnBlock(channels=in_ch))
-    modules.append(ResnetBlock(in_ch=in_ch))
+    add_stage('res', ResnetBlock(in_ch=in_ch))
+    add_stage('conv', AttnBlock(channels=in_ch))
+    add_stage('res', ResnetBlock(in_ch=in_ch))
 
     pyramid_ch = 0
     # Upsampling block
     for i_level in reversed(range(num_resolutions)):
       for i_block in range(num_res_blocks + 1):
         out_ch = nf * ch_mult[i_level]
-        modules.append(ResnetBlock(in_ch=in_ch + hs_c.pop(),
-                                   out_ch=out_ch))
+        add_stage('res_skip', ResnetBlock(in_ch=in_ch + hs_c.pop(),
+                                          out_ch=out_ch))
         in_ch = out_ch
 
       if all_resolutions[i_level] in attn_resolutions:
-        modules.append(AttnBlock(channels=in_ch))
+        add_stage('conv', AttnBlock(channels=in_ch))
 
       if progressive != 'none':
         if i_level == num_resolutions - 1:
           if progressive == 'output_skip':
-            modules.append(nn.GroupNorm(num_groups=min(in_ch // 4, 32),
-                                        num_channels=in_ch, eps=1e-6))
-            modules.append(conv3x3(in_ch, channels, init_scale=init_scale))
+            add_stage('pyramid_head',
+                      nn.GroupNorm(num_groups=min(in_ch // 4, 32),
+                                   num_channels=in_ch, eps=1e-6),
+                      conv3x3(in_ch, channels, init_scale=init_scale))
             pyramid_ch = channels
           elif progressive == 'residual':
-            modules.append(nn.GroupNorm(num_groups=min(in_ch // 4, 32),
-                                        num_channels=in_ch, eps=1e-6))
-            modules.append(conv3x3(in_ch, in_ch, bias=True))
+            add_stage('pyramid_head',
+                      nn.GroupNorm(num_groups=min(in_ch // 4, 32),
+                                   num_channels=in_ch, eps=1e-6),
+                      conv3x3(in_ch, in_ch, bias=True))
             pyramid_ch = in_ch
           else:
             raise ValueError(f'{progressive} is not a valid name.')
         else:
           if progressive == 'output_skip':
-            modules.append(nn.GroupNorm(num_groups=min(in_ch // 4, 32),
-                                        num_channels=in_ch, eps=1e-6))
-            modules.append(conv3x3(in_ch, channels, bias=True, init_scale=init_scale))
+            add_stage('pyramid_output_skip',
+                      nn.GroupNorm(num_groups=min(in_ch // 4, 32),
+                                   num_channels=in_ch, eps=1e-6),
+                      conv3x3(in_ch, channels, bias=True, init_scale=init_scale))
             pyramid_ch = channels
           elif progressive == 'residual':
-            modules.append(pyramid_upsample(in_ch=pyramid_ch, out_ch=in_ch))
+            add_stage('pyramid_residual', pyramid_upsample(in_ch=pyramid_ch, out_ch=in_ch))
             pyramid_ch = in_ch
           else:
             raise ValueError(f'{progressive} is not a valid name')
 
       if i_level != 0:
         if resblock_type == 'ddpm':
-          modules.append(Upsample(in_ch=in_ch))
+          add_stage('conv', Upsample(in_ch=in_ch))
         else:
-          modules.append(ResnetBlock(in_ch=in_ch, up=True))
+          add_stage('res', ResnetBlock(in_ch=in_ch, up=True))
 
     assert not hs_c
 
     if progressive != 'output_skip':
-      modules.append(nn.GroupNorm(num_groups=min(in_ch // 4, 32),
-                                  num_channels=in_ch, eps=1e-6))
-      modules.append(conv3x3(in_ch, channels, init_scale=init_scale))
+      add_stage('out',
+                nn.GroupNorm(num_groups=min(in_ch // 4, 32),
+                             num_channels=in_ch, eps=1e-6),
+                conv3x3(in_ch, channels, init_scale=init_scale))
+    else:
+      add_stage('out_pyramid')
+
+    assert resblock_hidden_ch is None or next(resblock_hidden_ch, None) is None
+    assert attn_hidden_ch is None or next(attn_hidden_ch, None) is None
 
     self.all_modules = nn.ModuleList(modules)
+    assert sum(len(stage.modules) for stage in plan) == len(self.all_modules)
+    self.plan = tuple(stage for stage in plan if stage.kind != 'unused')
     
     
     mapping_layers = [PixelNorm(),
@@ -278,151 +335,74 @@ class NCSNpp(nn.Module):
     
 
   def forward(self, x, time_cond, z):
-    # timestep/noise_level embedding; only for continuous training
     zemb = self.z_transform(z)
     modules = self.all_modules
-    m_idx = 0
-    if self.embedding_type == 'fourier':
-      # Gaussian Fourier features embeddings.
-      used_sigmas = time_cond
-      temb = modules[m_idx](torch.log(used_sigmas))
-      m_idx += 1
-
-    elif self.embedding_type == 'positional':
-      # Sinusoidal positional embeddings.
-      timesteps = time_cond
-     
-      temb = layers.get_timestep_embedding(timesteps, self.nf)
-
-    else:
-      raise ValueError(f'embedding type {self.embedding_type} unknown.')
-
-    if self.conditional:
-      temb = modules[m_idx](temb)
-      m_idx += 1
-      temb = modules[m_idx](self.act(temb))
-      m_idx += 1
-    else:
-      temb = None
+    temb = None
 
     if not self.config.centered:
       # If input data is in [0, 1]
       x = 2 * x - 1.
 
-    # Downsampling block
-    input_pyramid = None
-    if self.progressive_input != 'none':
-      input_pyramid = x
+    h = input_pyramid = x
+    pyramid = None
+    hs = []
 
-    hs = [modules[m_idx](x)]
-    m_idx += 1
-    for i_level in range(self.num_resolutions):
-      # Residual blocks for this resolution
-      for i_block in range(self.num_res_blocks):
-        h = modules[m_idx](hs[-1], temb, zemb)
-        m_idx += 1
-        if h.shape[-1] in self.attn_resolutions:
-          h = modules[m_idx](h)
-          m_idx += 1
+    for kind, idx in self.plan:
+      if kind == 'res':
+        h = modules[idx[0]](h, temb, zemb)
 
-        hs.append(h)
+      elif kind == 'res_skip':
+        # rebind h first, so the pre-concat h is freed before the block runs
+        h = torch.cat([h, hs.pop()], dim=1)
+        h = modules[idx[0]](h, temb, zemb)
 
-      if i_level != self.num_resolutions - 1:
-        if self.resblock_type == 'ddpm':
-          h = modules[m_idx](hs[-1])
-          m_idx += 1
-        else:
-          h = modules[m_idx](hs[-1], temb, zemb)
-          m_idx += 1
-
-        if self.progressive_input == 'input_skip':
-          input_pyramid = self.pyramid_downsample(input_pyramid)
-          h = modules[m_idx](input_pyramid, h)
-          m_idx += 1
-
-        elif self.progressive_input == 'residual':
-          input_pyramid = modules[m_idx](input_pyramid)
-          m_idx += 1
-          if self.skip_rescale:
-            input_pyramid = (input_pyramid + h) / np.sqrt(2.)
-          else:
-            input_pyramid = input_pyramid + h
-          h = input_pyramid
+      elif kind == 'conv':
+        h = modules[idx[0]](h)
 
+      elif kind == 'push':
         hs.append(h)
 
-    h = hs[-1]
-    h = modules[m_idx](h, temb, zemb)
-    m_idx += 1
-    h = modules[m_idx](h)
-    m_idx += 1
-    h = modules[m_idx](h, temb, zemb)
-    m_idx += 1
+      elif kind == 'embed_fourier':
+        # Gaussian Fourier features embeddings.
+        temb = modules[idx[0]](torch.log(time_cond))
 
-    pyramid = None
+      elif kind == 'embed_positional':
+        # Sinusoidal positional embeddings.
+        temb = layers.get_timestep_embedding(time_cond, self.nf)
 
-    # Upsampling block
-    for i_level in reversed(range(self.num_resolutions)):
-      for i_block in range(self.num_res_blocks + 1):
-        h = modules[m_idx](torch.cat([h, hs.pop()], dim=1), temb, zemb)
-        m_idx += 1
-
-      if h.shape[-1] in self.attn_resolutions:
-        h = modules[m_idx](h)
-        m_idx += 1
-
-      if self.progressive != 'none':
-        if i_level == self.num_resolutions - 1:
-          if self.progressive == 'output_skip':
-            pyramid = self.act(modules[m_idx](h))
-            m_idx += 1
-            pyramid = modules[m_idx](pyramid)
-            m_idx += 1
-          elif self.progressive == 'residual':
-            pyramid = self.act(modules[m_idx](h))
-            m_idx += 1
-            pyramid = modules[m_idx](pyramid)
-            m_idx += 1
-          else:
-            raise ValueError(f'{self.progressive} is not a valid name.')
-        else:
-          if self.progressive == 'output_skip':
-            pyramid = self.pyramid_upsample(pyramid)
-            pyramid_h = self.act(modules[m_idx](h))
-            m_idx += 1
-            pyramid_h = modules[m_idx](pyramid_h)
-            m_idx += 1
-            pyramid = pyramid + pyramid_h
-          elif self.progressive == 'residual':
-            pyramid = modules[m_idx](pyramid)
-            m_idx += 1
-            if self.skip_rescale:
-              pyramid = (pyramid + h) / np.sqrt(2.)
-            else:
-              pyramid = pyramid + h
-            h = pyramid
-          else:
-            raise ValueError(f'{self.progressive} is not a valid name')
+      elif kind == 'temb':
+        temb = modules[idx[1]](self.act(modules[idx[0]](temb)))
 
-      if i_level != 0:
-        if self.resblock_type == 'ddpm':
-          h = modules[m_idx](h)
-          m_idx += 1
-        else:
-          h = modules[m_idx](h, temb, zemb)
-          m_idx += 1
+      elif kind == 'input_skip':
+        input_pyramid = self.pyramid_downsample(input_pyramid)
+        h = modules[idx[0]](input_pyramid, h)
 
-    assert not hs
+      elif kind == 'input_residual':
+        input_pyramid = layerspp.residual_add(h, modules[idx[0]](input_pyramid), self.skip_rescale)
+        h = input_pyramid
 
-    if self.progressive == 'output_skip':
-      h = pyramid
-    else:
-      h = self.act(modules[m_idx](h))
-      m_idx += 1
-      h = modules[m_idx](h)
-      m_idx += 1
+      elif kind == 'pyramid_head':
+        pyramid = modules[idx[1]](layerspp.fresh_act(self.act, modules[idx[0]](h)))
+
+      elif kind == 'pyramid_output_skip':
+        pyramid = self.pyramid_upsample(pyramid)
+        pyramid_h = modules[idx[1]](layerspp.fresh_act(self.act, modules[idx[0]](h)))
+        pyramid = layerspp.residual_add(pyramid, pyramid_h)
+
+      elif kind == 'pyramid_residual':
+        pyramid = layerspp.residual_add(h, modules[idx[0]](pyramid), self.skip_rescale)
+        h = pyramid
 
-    assert m_idx == len(modules)
+      elif kind == 'out':
+        h = modules[idx[1]](layerspp.fresh_act(self.act, modules[idx[0]](h)))
+
+      elif kind == 'out_pyramid':
+        h = pyramid
+
+      else:
+        raise ValueError(f'stage {kind} unknown.')
+
+    assert not hs
     
     if not self.not_use_tanh:
 
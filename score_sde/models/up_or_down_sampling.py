@@ -46,12 +46,20 @@ class Conv2d(nn.Module):
     self.resample_kernel = resample_kernel
     self.kernel = kernel
     self.use_bias = use_bias
+    if up:
+      # Same filter as upsample_conv_2d, prepared once.
+      self.register_buffer('fir', torch.tensor(_setup_kernel(resample_kernel) * 4), persistent=False)
+    elif down:
+      # Same filter and padding as conv_downsample_2d, prepared once.
+      self.register_buffer('fir', torch.tensor(_setup_kernel(resample_kernel)), persistent=False)
+      p = (self.fir.shape[0] - 2) + (kernel - 1)
+      self.fir_pad = ((p + 1) // 2, p // 2)
 
   def forward(self, x):
     if self.up:
-      x = upsample_conv_2d(x, self.weight, k=self.resample_kernel)
+      x = _upsample_conv_2d(x, self.weight, self.fir, 2)
     elif self.down:
-      x = conv_downsample_2d(x, self.weight, k=self.resample_kernel)
+      x = F.conv2d(upfirdn2d(x, self.fir, pad=self.fir_pad), self.weight, stride=2)
     else:
       x = F.conv2d(x, self.weight, stride=1, padding=self.kernel // 2)
 
@@ -61,17 +69,67 @@ class Conv2d(nn.Module):
     return x
 
 
+class Upsample2d(nn.Module):
+  """`upsample_2d` with the FIR kernel prepared once and kept in a non-persistent buffer."""
+
+  def __init__(self, k=None, factor=2, gain=1):
+    super().__init__()
+    if k is None:
+      k = [1] * factor
+    self.register_buffer('fir', torch.tensor(_setup_kernel(k) * (gain * (factor ** 2))), persistent=False)
+    p = self.fir.shape[0] - factor
+    self.factor = factor
+    self.pad = ((p + 1) // 2 + factor - 1, p // 2)
+
+  def forward(self, x):
+    return upfirdn2d(x, self.fir, up=self.factor, pad=self.pad)
+
+  def upsample_conv(self, x, w):
+    """`F.conv2d(self(x), w, padding=w.shape[-1] // 2)` without upsampling `x` itself.
+
+    `upsample_conv_2d` keeps the filter tails beyond the image that `self(x)` crops, which
+    reach the outer `w.shape[-1] // 2` output rows and columns. Those are recomputed
+    unfused from thin strips of `x`, so the result matches up to rounding.
+    """
+    r = w.shape[-1] // 2
+    # input rows that determine the upsampled rows read by the outer r output rows
+    s = (2 * r + self.fir.shape[0]) // self.factor + 1
+    H, W = x.shape[2:]
+    if r == 0 or 2 * s >= min(H, W):
+      return F.conv2d(self(x), w, padding=r)
+
+    out = _upsample_conv_2d(x, w, self.fir, self.factor)
+    out[:, :, :r] = F.conv2d(self(x[:, :, :s]), w, padding=r)[:, :, :r]
+    out[:, :, -r:] = F.conv2d(self(x[:, :, -s:]), w, padding=r)[:, :, -r:]
+    out[:, :, :, :r] = F.conv2d(self(x[:, :, :, :s]), w, padding=r)[:, :, :, :r]
+    out[:, :, :, -r:] = F.conv2d(self(x[:, :, :, -s:]), w, padding=r)[:, :, :, -r:]
+    return out
+
+
+class Downsample2d(nn.Module):
+  """`downsample_2d` with the FIR kernel prepared once and kept in a non-persistent buffer."""
+
+  def __init__(self, k=None, factor=2, gain=1):
+    super().__init__()
+    if k is None:
+      k = [1] * factor
+    self.register_buffer('fir', torch.tensor(_setup_kernel(k) * gain), persistent=False)
+    p = self.fir.shape[0] - factor
+    self.factor = factor
+    self.pad = ((p + 1) // 2, p // 2)
+
+  def forward(self, x):
+    return upfirdn2d(x, self.fir, down=self.factor, pad=self.pad)
+
+
 def naive_upsample_2d(x, factor=2):
-  _N, C, H, W = x.shape
-  x = torch.reshape(x, (-1, C, H, 1, W, 1))
-  x = x.repeat(1, 1, 1, factor, 1, factor)
-  return torch.reshape(x, (-1, C, H * factor, W * factor))
+  # Nearest-neighbor repeat; keeps the memory format of `x`.
+  return F.interpolate(x, scale_factor=factor, mode='nearest')
 
 
 def naive_downsample_2d(x, factor=2):
-  _N, C, H, W = x.shape
-  x = torch.reshape(x, (-1, C, H // factor, factor, W // factor, factor))
-  return torch.mean(x, dim=(3, 5))
+  # Mean over non-overlapping factor x factor blocks; keeps the memory format of `x`.
+  return F.avg_pool2d(x, factor, stride=factor)
 
 
 def upsample_conv_2d(x, w, k=None, factor=2, gain=1):
@@ -101,6 +159,15 @@ def upsample_conv_2d(x, w, k=None, factor=2, gain=1):
 
   assert isinstance(factor, int) and factor >= 1
 
+  # Setup filter kernel.
+  if k is None:
+    k = [1] * factor
+  k = _setup_kernel(k) * (gain * (factor ** 2))
+  return _upsample_conv_2d(x, w, torch.tensor(k, device=x.device), factor)
+
+
+def _upsample_conv_2d(x, w, k, factor):
+  """`upsample_conv_2d` with the FIR kernel `k` already set up as a tensor."""
   # Check weight shape.
   assert len(w.shape) == 4
   convH = w.shape[2]
@@ -110,28 +177,18 @@ def upsample_conv_2d(x, w, k=None, factor=2, gain=1):
 
   assert convW == convH
 
-  # Setup filter kernel.
-  if k is None:
-    k = [1] * factor
-  k = _setup_kernel(k) * (gain * (factor ** 2))
   p = (k.shape[0] - factor) - (convW - 1)
 
-  stride = (factor, factor)
-
-  # Determine data dimensions.
-  stride = [1, 1, factor, factor]
-  output_shape = ((_shape(x, 2) - 1) * factor + convH, (_shape(x, 3) - 1) * factor + convW)
-  output_padding = (output_shape[0] - (_shape(x, 2) - 1) * stride[0] - convH,
-                    output_shape[1] - (_shape(x, 3) - 1) * stride[1] - convW)
-  assert output_padding[0] >= 0 and output_padding[1] >= 0
+  # The transposed conv below yields the full (H - 1) * factor + convH rows,
+  # so no output_padding is needed.
   num_groups = _shape(x, 1) // inC
 
   # Transpose weights.
   w = torch.reshape(w, (num_groups, -1, inC, convH, convW))
-  w = w[..., ::-1, ::-1].permute(0, 2, 1, 3, 4)
+  w = torch.flip(w, [3, 4]).permute(0, 2, 1, 3, 4)
   w = torch.reshape(w, (num_groups * inC, -1, convH, convW))
 
-  x = F.conv_transpose2d(x, w, stride=stride, output_padding=output_padding, padding=0)
+  x = F.conv_transpose2d(x, w, stride=factor, groups=num_groups)
   ## Original TF code.
   # x = tf.nn.conv2d_transpose(
   #     x,
@@ -142,8 +199,7 @@ def upsample_conv_2d(x, w, k=None, factor=2, gain=1):
   #     data_format=data_format)
   ## JAX equivalent
 
-  return upfirdn2d(x, torch.tensor(k, device=x.device),
-                   pad=((p + 1) // 2 + factor - 1, p // 2 + 1))
+  return upfirdn2d(x, k, pad=((p + 1) // 2 + factor - 1, p // 2 + factor - 1))
 
 
 def conv_downsample_2d(x, w, k=None, factor=2, gain=1):
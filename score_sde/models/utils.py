@@ -138,6 +138,43 @@ def get_model_fn(model, train=False):
 
 
 
+def find_layout_conversions(model, *inputs, memory_format=torch.channels_last):
+  """Run `model` on `inputs` and list the modules around which the memory layout changes.
+
+  A module is reported when it receives a 4-D tensor that is not in `memory_format`,
+  or when one of its 4-D inputs is in `memory_format` but its 4-D output is not.
+  Only the innermost module of a nested chain is listed.
+
+  Returns:
+    A list of module names as given by `model.named_modules()`.
+  """
+
+  def in_format(x):
+    return torch.is_tensor(x) and x.dim() == 4 and x.is_contiguous(memory_format=memory_format)
+
+  conversions = []
+
+  def make_hook(name):
+    def hook(module, args, output):
+      tensors = [a for a in args if torch.is_tensor(a) and a.dim() == 4]
+      if any(not in_format(a) for a in tensors):
+        conversions.append(name)
+      elif tensors and torch.is_tensor(output) and output.dim() == 4 and not in_format(output):
+        conversions.append(name)
+    return hook
+
+  handles = [module.register_forward_hook(make_hook(name)) for name, module in model.named_modules()]
+  try:
+    with torch.no_grad():
+      model(*inputs)
+  finally:
+    for handle in handles:
+      handle.remove()
+
+  return [name for name in conversions
+          if not any(other != name and other.startswith(name + '.' if name else '') for other in conversions)]
+
+
 def to_flattened_numpy(x):
   """Flatten a torch tensor `x` and convert it to numpy."""
   return x.detach().cpu().numpy().reshape((-1,))
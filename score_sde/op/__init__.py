@@ -1,2 +1,3 @@
 from .fused_act import FusedLeakyReLU, fused_leaky_relu
 from .upfirdn2d import upfirdn2d
+from .fused_adagn import fused_adaptive_group_norm, adaptive_group_norm_ref
@@ -0,0 +1,29 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+# ---------------------------------------------------------------
+
+"""On-demand building of the C++/CUDA extensions in this directory."""
+
+import os
+import warnings
+
+module_path = os.path.dirname(__file__)
+_extensions = {}
+
+
+def load_extension(name, sources):
+    """Return the extension `name` built from `sources`, compiling it on the first call.
+
+    Builds are cached by torch.utils.cpp_extension under $TORCH_EXTENSIONS_DIR (by default
+    ~/.cache/torch_extensions) and only recompiled when a source changes. Returns None,
+    once and for all, if the extension cannot be built, e.g. on hosts without nvcc.
+    """
+    if name not in _extensions:
+        try:
+            from torch.utils.cpp_extension import load
+
+            _extensions[name] = load(name, sources=[os.path.join(module_path, s) for s in sources])
+        except Exception as e:
+            warnings.warn("Could not build the {} extension, using the PyTorch implementation: {}".format(name, e))
+            _extensions[name] = None
+    return _extensions[name]
@@ -0,0 +1,91 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+# ---------------------------------------------------------------
+
+"""Adaptive group normalization fused with its style modulation and an optional SiLU."""
+
+import torch
+from torch.nn import functional as F
+from torch.autograd import Function
+
+
+def adaptive_group_norm_ref(input, gamma, beta, num_groups, eps=1e-5, silu=False):
+    """Reference implementation: `gamma * group_norm(input) + beta`, then SiLU if `silu`.
+
+    `gamma` and `beta` hold one value per sample and channel, shape (N, C).
+    """
+    out = F.group_norm(input, num_groups, eps=eps)
+    out = gamma[:, :, None, None] * out + beta[:, :, None, None]
+    return F.silu(out) if silu else out
+
+
+def _group_stats(input, num_groups, eps):
+    n, c, h, w = input.shape
+    # Splitting the channel axis is a view for both memory formats.
+    var, mean = torch.var_mean(input.view(n, num_groups, c // num_groups, h, w), dim=(2, 3, 4), unbiased=False)
+    return mean, (var + eps).rsqrt()
+
+
+def _per_channel(stat, channels):
+    return stat.repeat_interleave(channels // stat.shape[1], dim=1)
+
+
+def _group_sum(t, num_groups):
+    n, c = t.shape
+    return _per_channel(t.view(n, num_groups, c // num_groups).sum(2), c)
+
+
+class FusedAdaptiveGroupNormFunction(Function):
+    @staticmethod
+    def forward(ctx, input, gamma, beta, num_groups, eps, silu):
+        mean, rstd = _group_stats(input, num_groups, eps)
+        scale = gamma * _per_channel(rstd, input.shape[1])
+        shift = beta - _per_channel(mean, input.shape[1]) * scale
+        # A single full-size output; the normalized input is never materialized.
+        out = torch.addcmul(shift[:, :, None, None], input, scale[:, :, None, None])
+        if silu:
+            out = F.silu(out, inplace=True)
+
+        ctx.save_for_backward(input, mean, rstd, gamma, beta)
+        ctx.num_groups = num_groups
+        ctx.eps = eps
+        ctx.silu = silu
+
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, mean, rstd, gamma, beta = ctx.saved_tensors
+        num_groups = ctx.num_groups
+        n, c, h, w = input.shape
+
+        # Everything below is made of differentiable ops, so with create_graph the backward
+        # pass is itself differentiable. The statistics then have to be functions of input.
+        if torch.is_grad_enabled():
+            mean, rstd = _group_stats(input, num_groups, ctx.eps)
+        mean, rstd = _per_channel(mean, c), _per_channel(rstd, c)
+
+        x_hat = (input - mean[:, :, None, None]) * rstd[:, :, None, None]
+        if ctx.silu:
+            y = gamma[:, :, None, None] * x_hat + beta[:, :, None, None]
+            sig = torch.sigmoid(y)
+            grad_output = grad_output * sig * (1 + y * (1 - sig))
+
+        grad_gamma = (grad_output * x_hat).sum((2, 3))
+        grad_beta = grad_output.sum((2, 3))
+
+        grad_input = None
+        if ctx.needs_input_grad[0]:
+            count = c // num_groups * h * w
+            mean_dy = _group_sum(gamma * grad_beta, num_groups) / count
+            mean_dy_x_hat = _group_sum(gamma * grad_gamma, num_groups) / count
+            grad_input = (grad_output * (gamma * rstd)[:, :, None, None]
+                          - (rstd * mean_dy)[:, :, None, None]
+                          - x_hat * (rstd * mean_dy_x_hat)[:, :, None, None])
+
+        return grad_input, grad_gamma, grad_beta, None, None, None
+
+
+def fused_adaptive_group_norm(input, gamma, beta, num_groups, eps=1e-5, silu=False):
+    """Same result as adaptive_group_norm_ref, keeping one activation-sized tensor for backward."""
+    return FusedAdaptiveGroupNormFunction.apply(input, gamma, beta, num_groups, eps, silu)
@@ -6,22 +6,35 @@
 The license for the original version of this file can be found in this directory (LICENSE_MIT).
 """
 
-import os
-
 import torch
 from torch.nn import functional as F
 from torch.autograd import Function
-from torch.utils.cpp_extension import load
 from collections import abc
 
-module_path = os.path.dirname(__file__)
-upfirdn2d_op = load(
-    "upfirdn2d",
-    sources=[
-        os.path.join(module_path, "upfirdn2d.cpp"),
-        os.path.join(module_path, "upfirdn2d_kernel.cu"),
-    ],
-)
+from .ext_loader import load_extension
+
+
+def _upfirdn2d_op():
+    return load_extension("upfirdn2d", ["upfirdn2d.cpp", "upfirdn2d_kernel.cu"])
+
+
+def _memory_format(x):
+    if x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous():
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+def _to_kernel_layout(x):
+    """View (N, C, H, W) as the (major, H, W, minor) layout of the kernel without copying."""
+    if _memory_format(x) == torch.channels_last:
+        return x.permute(0, 2, 3, 1)
+    return x.reshape(-1, x.shape[2], x.shape[3], 1)
+
+
+def _from_kernel_layout(x, channel, memory_format):
+    if memory_format == torch.channels_last:
+        return x.permute(0, 3, 1, 2)
+    return x.view(-1, channel, x.shape[1], x.shape[2])
 
 
 class UpFirDn2dBackward(Function):
@@ -34,9 +47,10 @@ class UpFirDn2dBackward(Function):
         down_x, down_y = down
         g_pad_x0, g_pad_x1, g_pad_y0, g_pad_y1 = g_pad
 
-        grad_output = grad_output.reshape(-1, out_size[0], out_size[1], 1)
+        memory_format = _memory_format(grad_output)
+        grad_output = _to_kernel_layout(grad_output)
 
-        grad_input = upfirdn2d_op.upfirdn2d(
+        grad_input = _upfirdn2d_op().upfirdn2d(
             grad_output,
             grad_kernel,
             down_x,
@@ -48,7 +62,7 @@ class UpFirDn2dBackward(Function):
             g_pad_y0,
             g_pad_y1,
         )
-        grad_input = grad_input.view(in_size[0], in_size[1], in_size[2], in_size[3])
+        grad_input = _from_kernel_layout(grad_input, in_size[1], memory_format)
 
         ctx.save_for_backward(kernel)
 
@@ -71,9 +85,10 @@ class UpFirDn2dBackward(Function):
     def backward(ctx, gradgrad_input):
         kernel, = ctx.saved_tensors
 
-        gradgrad_input = gradgrad_input.reshape(-1, ctx.in_size[2], ctx.in_size[3], 1)
+        memory_format = _memory_format(gradgrad_input)
+        gradgrad_input = _to_kernel_layout(gradgrad_input)
 
-        gradgrad_out = upfirdn2d_op.upfirdn2d(
+        gradgrad_out = _upfirdn2d_op().upfirdn2d(
             gradgrad_input,
             kernel,
             ctx.up_x,
@@ -85,10 +100,7 @@ class UpFirDn2dBackward(Function):
             ctx.pad_y0,
             ctx.pad_y1,
         )
-        # gradgrad_out = gradgrad_out.view(ctx.in_size[0], ctx.out_size[0], ctx.out_size[1], ctx.in_size[3])
-        gradgrad_out = gradgrad_out.view(
-            ctx.in_size[0], ctx.in_size[1], ctx.out_size[0], ctx.out_size[1]
-        )
+        gradgrad_out = _from_kernel_layout(gradgrad_out, ctx.in_size[1], memory_format)
 
         return gradgrad_out, None, None, None, None, None, None, None, None
 
@@ -104,7 +116,8 @@ class UpFirDn2d(Function):
         batch, channel, in_h, in_w = input.shape
         ctx.in_size = input.shape
 
-        input = input.reshape(-1, in_h, in_w, 1)
+        memory_format = _memory_format(input)
+        input = _to_kernel_layout(input)
 
         ctx.save_for_backward(kernel, torch.flip(kernel, [0, 1]))
 
@@ -123,11 +136,10 @@ class UpFirDn2d(Function):
 
         ctx.g_pad = (g_pad_x0, g_pad_x1, g_pad_y0, g_pad_y1)
 
-        out = upfirdn2d_op.upfirdn2d(
+        out = _upfirdn2d_op().upfirdn2d(
             input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
         )
-        # out = out.view(major, out_h, out_w, minor)
-        out = out.view(-1, channel, out_h, out_w)
+        out = _from_kernel_layout(out, channel, memory_format)
 
         return out
 
@@ -151,12 +163,19 @@ class UpFirDn2d(Function):
 
 
 def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
-    if input.device.type == "cpu":
+    """Upsample, FIR filter and downsample `input`.
+
+    `kernel` is either 2-D or a 1-D kernel applied to both axes, i.e. the separable
+    2-D kernel `outer(kernel, kernel)`.
+    """
+    if input.device.type == "cpu" or _upfirdn2d_op() is None:
         out = upfirdn2d_native(
             input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1]
         )
 
     else:
+        if kernel.ndim == 1:
+            kernel = kernel[:, None] * kernel[None, :]
         out = UpFirDn2d.apply(
             input, kernel, (up, up), (down, down), (pad[0], pad[1], pad[0], pad[1])
         )
@@ -173,10 +192,12 @@ def upfirdn2d_ada(input, kernel, up=1, down=1, pad=(0, 0)):
     if len(pad) == 2:
         pad = (pad[0], pad[1], pad[0], pad[1])
 
-    if input.device.type == "cpu":
+    if input.device.type == "cpu" or _upfirdn2d_op() is None:
         out = upfirdn2d_native(input, kernel, *up, *down, *pad)
 
     else:
+        if kernel.ndim == 1:
+            kernel = kernel[:, None] * kernel[None, :]
         out = UpFirDn2d.apply(input, kernel, up, down, pad)
 
     return out
@@ -184,42 +205,50 @@ def upfirdn2d_ada(input, kernel, up=1, down=1, pad=(0, 0)):
 def upfirdn2d_native(
     input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
 ):
-    _, channel, in_h, in_w = input.shape
-    input = input.reshape(-1, in_h, in_w, 1)
+    # Filters every channel separately with a depthwise conv on the original
+    # (N, C, H, W) tensor, so channels_last inputs stay channels_last.
+    if kernel.ndim == 1:
+        # Separable kernel: one 1-D pass along y, then one along x.
+        out = upfirdn2d_native(
+            input, kernel.view(-1, 1), 1, up_y, 1, down_y, 0, 0, pad_y0, pad_y1
+        )
+        return upfirdn2d_native(
+            out, kernel.view(1, -1), up_x, 1, down_x, 1, pad_x0, pad_x1, 0, 0
+        )
 
-    _, in_h, in_w, minor = input.shape
+    batch, channel, in_h, in_w = input.shape
     kernel_h, kernel_w = kernel.shape
 
-    out = input.view(-1, in_h, 1, in_w, 1, minor)
-    out = F.pad(out, [0, 0, 0, up_x - 1, 0, 0, 0, up_y - 1])
-    out = out.view(-1, in_h * up_y, in_w * up_x, minor)
+    if up_x > 1 or up_y > 1:
+        # Polyphase upsampling: the transposed conv only multiplies the input samples,
+        # never the zeros that upsampling interleaves between them. Its output is the
+        # full convolution, which the padding below (negative values crop) aligns.
+        w = kernel.view(1, 1, kernel_h, kernel_w).expand(channel, 1, kernel_h, kernel_w)
+        out = F.conv_transpose2d(input, w, stride=(up_y, up_x), groups=channel)
+        out = F.pad(
+            out,
+            [
+                pad_x0 - kernel_w + 1,
+                up_x + pad_x1 - kernel_w,
+                pad_y0 - kernel_h + 1,
+                up_y + pad_y1 - kernel_h,
+            ],
+        )
+        if down_x > 1 or down_y > 1:
+            out = out[:, :, ::down_y, ::down_x].contiguous(memory_format=_memory_format(input))
+        return out
 
     out = F.pad(
-        out, [0, 0, max(pad_x0, 0), max(pad_x1, 0), max(pad_y0, 0), max(pad_y1, 0)]
+        input, [max(pad_x0, 0), max(pad_x1, 0), max(pad_y0, 0), max(pad_y1, 0)]
     )
     out = out[
         :,
-        max(-pad_y0, 0) : out.shape[1] - max(-pad_y1, 0),
-        max(-pad_x0, 0) : out.shape[2] - max(-pad_x1, 0),
         :,
+        max(-pad_y0, 0) : out.shape[2] - max(-pad_y1, 0),
+        max(-pad_x0, 0) : out.shape[3] - max(-pad_x1, 0),
     ]
 
-    out = out.permute(0, 3, 1, 2)
-    out = out.reshape(
-        [-1, 1, in_h * up_y + pad_y0 + pad_y1, in_w * up_x + pad_x0 + pad_x1]
-    )
     w = torch.flip(kernel, [0, 1]).view(1, 1, kernel_h, kernel_w)
-    out = F.conv2d(out, w)
-    out = out.reshape(
-        -1,
-        minor,
-        in_h * up_y + pad_y0 + pad_y1 - kernel_h + 1,
-        in_w * up_x + pad_x0 + pad_x1 - kernel_w + 1,
-    )
-    out = out.permute(0, 2, 3, 1)
-    out = out[:, ::down_y, ::down_x, :]
-
-    out_h = (in_h * up_y + pad_y0 + pad_y1 - kernel_h) // down_y + 1
-    out_w = (in_w * up_x + pad_x0 + pad_x1 - kernel_w) // down_x + 1
+    w = w.expand(channel, 1, kernel_h, kernel_w)
 
-    return out.view(-1, channel, out_h, out_w)
+    return F.conv2d(out, w, stride=(down_y, down_x), groups=channel)
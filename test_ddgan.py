@@ -9,6 +9,7 @@ import torch
 import numpy as np
 
 import os
+import time
 
 import torchvision
 from score_sde.models.ncsnpp_generator_adagn import NCSNpp
@@ -112,78 +113,123 @@ def sample_posterior(coefficients, x_0,x_t, t):
     
     return sample_x_pos
 
+def generate(generator, x, t, latent_z, max_batch=None):
+    """Run `generator` on at most `max_batch` samples at a time, bounding its activation memory."""
+    if not max_batch or x.size(0) <= max_batch:
+        return generator(x, t, latent_z)
+    return torch.cat([generator(*chunk) for chunk in
+                      zip(x.split(max_batch), t.split(max_batch), latent_z.split(max_batch))])
+
 def sample_from_model(coefficients, generator, n_time, x_init, T, opt):
     x = x_init
-    with torch.no_grad():
+    # inference_mode is not available before torch 1.9.
+    with getattr(torch, 'inference_mode', torch.no_grad)():
         for i in reversed(range(n_time)):
             t = torch.full((x.size(0),), i, dtype=torch.int64).to(x.device)
             
             t_time = t
             latent_z = torch.randn(x.size(0), opt.nz, device=x.device)#.to(x.device)
-            x_0 = generator(x, t_time, latent_z)
+            x_0 = generate(generator, x, t_time, latent_z, getattr(opt, 'max_gen_batch', None))
             x_new = sample_posterior(coefficients, x_0, x, t)
             x = x_new.detach()
         
     return x
 
 #%%
-def sample_and_test(args):
-    torch.manual_seed(42)
-    device = 'cuda:0'
-    
+def get_real_img_dir(args):
     if args.dataset == 'cifar10':
-        real_img_dir = 'pytorch_fid/cifar10_train_stat.npy'
+        return 'pytorch_fid/cifar10_train_stat.npy'
     elif args.dataset == 'celeba_256':
-        real_img_dir = 'pytorch_fid/celeba_256_stat.npy'
+        return 'pytorch_fid/celeba_256_stat.npy'
     elif args.dataset == 'lsun':
-        real_img_dir = 'pytorch_fid/lsun_church_stat.npy'
+        return 'pytorch_fid/lsun_church_stat.npy'
     else:
-        real_img_dir = args.real_img_dir
-    
-    to_range_0_1 = lambda x: (x + 1.) / 2.
+        return args.real_img_dir
 
+def load_generator(args, device):
+    """Build NCSNpp from `args` and load the checkpoint of `args.epoch_id` (or `args.ckpt`).
     
-    netG = NCSNpp(args).to(device)
-    ckpt = torch.load('./saved_info/dd_gan/{}/{}/netG_{}.pth'.format(args.dataset, args.exp, args.epoch_id), map_location=device)
+    Checkpoints written by prune_ddgan.py carry their own config, which overrides `args`.
+    """
+    ckpt_file = args.ckpt
+    if ckpt_file is None:
+        ckpt_file = './saved_info/dd_gan/{}/{}/netG_{}.pth'.format(args.dataset, args.exp, args.epoch_id)
+    ckpt = torch.load(ckpt_file, map_location=device)
     
-    #loading weights from ddp in single gpu
-    for key in list(ckpt.keys()):
-        ckpt[key[7:]] = ckpt.pop(key)
+    if 'netG_dict' in ckpt:
+        config = argparse.Namespace(**{**vars(args), **ckpt['config']})
+        ckpt = ckpt['netG_dict']
+    else:
+        config = args
+        #loading weights from ddp in single gpu
+        for key in list(ckpt.keys()):
+            ckpt[key[7:]] = ckpt.pop(key)
+    
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    netG = NCSNpp(config).to(device, memory_format=memory_format)
     netG.load_state_dict(ckpt)
     netG.eval()
+    return netG
+
+def sample_batch(netG, pos_coeff, T, args, device):
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    x_t_1 = torch.randn(args.batch_size, args.num_channels,args.image_size, args.image_size).to(device, memory_format=memory_format)
+    return sample_from_model(pos_coeff, netG, args.num_timesteps, x_t_1, T, args)
+
+def compute_fid(netG, pos_coeff, T, args, device, save_dir, num_samples=50000):
+    """Save `num_samples` samples of `netG` to `save_dir` and return their FID."""
+    to_range_0_1 = lambda x: (x + 1.) / 2.
+    
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    
+    iters_needed = num_samples //args.batch_size
+    for i in range(iters_needed):
+        with torch.no_grad():
+            fake_sample = sample_batch(netG, pos_coeff, T, args, device)
+            
+            fake_sample = to_range_0_1(fake_sample)
+            for j, x in enumerate(fake_sample):
+                index = i * args.batch_size + j 
+                torchvision.utils.save_image(x, os.path.join(save_dir, '{}.jpg'.format(index)))
+            print('generating batch ', i)
+    
+    paths = [save_dir, get_real_img_dir(args)]
+    
+    kwargs = {'batch_size': 100, 'device': device, 'dims': 2048}
+    return calculate_fid_given_paths(paths=paths, **kwargs)
+
+def measure_throughput(netG, pos_coeff, T, args, device, iters=10):
+    """Return the sampling throughput of `netG` in images per second."""
+    sample_batch(netG, pos_coeff, T, args, device)
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iters):
+        sample_batch(netG, pos_coeff, T, args, device)
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+    return iters * args.batch_size / (time.time() - start)
+
+def sample_and_test(args):
+    torch.manual_seed(42)
+    device = 'cuda:0'
     
+    to_range_0_1 = lambda x: (x + 1.) / 2.
+
+    netG = load_generator(args, device)
     
     T = get_time_schedule(args, device)
     
     pos_coeff = Posterior_Coefficients(args, device)
-        
-    iters_needed = 50000 //args.batch_size
     
     save_dir = "./generated_samples/{}".format(args.dataset)
     
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-    
     if args.compute_fid:
-        for i in range(iters_needed):
-            with torch.no_grad():
-                x_t_1 = torch.randn(args.batch_size, args.num_channels,args.image_size, args.image_size).to(device)
-                fake_sample = sample_from_model(pos_coeff, netG, args.num_timesteps, x_t_1,T,  args)
-                
-                fake_sample = to_range_0_1(fake_sample)
-                for j, x in enumerate(fake_sample):
-                    index = i * args.batch_size + j 
-                    torchvision.utils.save_image(x, './generated_samples/{}/{}.jpg'.format(args.dataset, index))
-                print('generating batch ', i)
-        
-        paths = [save_dir, real_img_dir]
-    
-        kwargs = {'batch_size': 100, 'device': device, 'dims': 2048}
-        fid = calculate_fid_given_paths(paths=paths, **kwargs)
+        fid = compute_fid(netG, pos_coeff, T, args, device, save_dir)
         print('FID = {}'.format(fid))
     else:
-        x_t_1 = torch.randn(args.batch_size, args.num_channels,args.image_size, args.image_size).to(device)
-        fake_sample = sample_from_model(pos_coeff, netG, args.num_timesteps, x_t_1,T,  args)
+        fake_sample = sample_batch(netG, pos_coeff, T, args, device)
         fake_sample = to_range_0_1(fake_sample)
         torchvision.utils.save_image(fake_sample, './samples_{}.jpg'.format(args.dataset))
 
@@ -191,7 +237,7 @@ def sample_and_test(args):
     
             
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser('ddgan parameters')
     parser.add_argument('--seed', type=int, default=1024,
                         help='seed used for initialization')
@@ -246,6 +292,12 @@ if __name__ == '__main__':
     parser.add_argument('--fourier_scale', type=float, default=16.,
                             help='scale of fourier transform')
     parser.add_argument('--not_use_tanh', action='store_true',default=False)
+    parser.add_argument('--channels_last', action='store_true', default=False,
+                        help='run G in channels_last memory format')
+    parser.add_argument('--fused_adagn', action='store_true', default=False,
+                        help='fuse adaptive group norm, modulation and SiLU in the resnet blocks')
+    parser.add_argument('--fused_resample', action='store_true', default=False,
+                        help='fuse FIR upsampling into the convs of the BigGAN up blocks (faster with --channels_last)')
     
     #geenrator and training
     parser.add_argument('--exp', default='experiment_cifar_default', help='name of experiment')
@@ -262,14 +314,18 @@ if __name__ == '__main__':
     parser.add_argument('--z_emb_dim', type=int, default=256)
     parser.add_argument('--t_emb_dim', type=int, default=256)
     parser.add_argument('--batch_size', type=int, default=200, help='sample generating batch size')
-        
+    parser.add_argument('--max_gen_batch', type=int, default=None,
+                        help='run G on at most this many samples at once, to sample large batches in less memory')
+    parser.add_argument('--ckpt', default=None,
+                        help='generator checkpoint to load instead of the one of --epoch_id')
+    return parser
 
 
-
-   
-    args = parser.parse_args()
+if __name__ == '__main__':
+    args = get_parser().parse_args()
     
     sample_and_test(args)
+
     
    
                 
\ No newline at end of file
@@ -0,0 +1,31 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import pytest
+import torch
+
+from score_sde.models.discriminator import Discriminator_small, Discriminator_large
+
+
+@pytest.mark.parametrize('netD_class, image_size', [(Discriminator_small, 32), (Discriminator_large, 64)])
+@pytest.mark.parametrize('batch_size', [2, 8])
+def test_joint_pass_matches_separate_passes(netD_class, image_size, batch_size):
+    torch.manual_seed(0)
+    netD = netD_class(nc=6, ngf=8, t_emb_dim=16)
+    # final_conv starts at zero, which would hide the stddev features
+    for param in netD.parameters():
+        param.data.normal_(0, 0.2)
+    real, fake, x_tp1 = torch.randn(3, batch_size, 3, image_size, image_size)
+    t = torch.randint(0, 4, (batch_size,))
+
+    D_real = netD(real, t, x_tp1)
+    D_fake = netD(fake, t, x_tp1)
+    D_joint = netD(torch.cat([real, fake]), torch.cat([t, t]), torch.cat([x_tp1, x_tp1]), num_splits=2)
+    assert torch.allclose(D_joint, torch.cat([D_real, D_fake]), rtol=1e-5, atol=1e-6)
+
+    # without the split, stddev groups mix real and fake samples
+    D_mixed = netD(torch.cat([real, fake]), torch.cat([t, t]), torch.cat([x_tp1, x_tp1]))
+    assert not torch.allclose(D_mixed, torch.cat([D_real, D_fake]), rtol=1e-3, atol=0)
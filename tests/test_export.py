@@ -0,0 +1,59 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import pytest
+import torch
+
+from export_ddgan import export
+from score_sde.models.ncsnpp_generator_adagn import NCSNpp
+from test_ddgan import load_generator, get_time_schedule, Posterior_Coefficients, sample_from_model
+from tests.test_quantize import sampling_args
+
+
+def export_sampler(netG, args, tmp_path):
+    args.ckpt = str(tmp_path / 'netG.pth')
+    args.device = 'cpu'
+    args.output = str(tmp_path / 'sampler.pt')
+    torch.save({'netG_dict': netG.state_dict(), 'config': {}}, args.ckpt)
+    export(args)
+    return torch.jit.load(args.output)
+
+
+def test_export_fused_adagn(tmp_path):
+    args = sampling_args('--fused_adagn')
+    torch.manual_seed(0)
+    sampler = export_sampler(NCSNpp(args), args, tmp_path)
+    x = torch.randn(args.batch_size, args.num_channels, args.image_size, args.image_size)
+    with torch.no_grad():
+        assert torch.isfinite(sampler(x)).all()
+
+
+@pytest.mark.parametrize('flags', [[], ['--channels_last'], ['--fused_resample'], ['--fused_adagn'],
+                                   ['--fused_resample', '--fused_adagn', '--channels_last']])
+def test_sampler_matches_sample_from_model(tmp_path, flags):
+    args = sampling_args(*flags)
+    torch.manual_seed(0)
+    netG = NCSNpp(args)
+    # The output conv starts at zero; random weights make every layer show in the samples.
+    for param in netG.parameters():
+        param.data.normal_(0, 0.1)
+    sampler = export_sampler(netG, args, tmp_path)
+    netG = load_generator(args, 'cpu')
+    T = get_time_schedule(args, 'cpu')
+    pos_coeff = Posterior_Coefficients(args, 'cpu')
+
+    x = torch.randn(args.batch_size, args.num_channels, args.image_size, args.image_size)
+    torch.manual_seed(1)
+    expected = sample_from_model(pos_coeff, netG, args.num_timesteps, x, T, args)
+    torch.manual_seed(1)
+    with torch.no_grad():
+        samples = sampler(x)
+    if args.fused_adagn:
+        # The traced generator takes the GroupNorm path instead of the fused norm.
+        assert torch.allclose(samples, expected, rtol=0, atol=1e-5)
+    else:
+        assert torch.equal(samples, expected)
+    assert expected.abs().mean() > 0.1
@@ -0,0 +1,29 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import pytest
+import torch
+from torch.utils.data.distributed import DistributedSampler
+
+from datasets_prep.in_memory import InMemoryLoader
+
+
+@pytest.mark.parametrize('length, num_replicas', [(24, 1), (24, 4), (23, 3), (10, 4), (2, 5)])
+def test_rank_order_matches_distributed_sampler(length, num_replicas):
+    images = torch.arange(length)
+    batch_size = 1 if length < num_replicas else 2
+    for rank in range(num_replicas):
+        loader = InMemoryLoader(images, -images, batch_size, num_replicas=num_replicas, rank=rank, seed=5)
+        sampler = DistributedSampler(range(length), num_replicas=num_replicas, rank=rank, seed=5)
+        for epoch in range(3):
+            loader.set_epoch(epoch)
+            sampler.set_epoch(epoch)
+            expected = list(sampler)
+            expected = expected[:len(expected) // batch_size * batch_size]
+            batches = list(loader)
+            assert len(batches) == len(loader)
+            assert [index for batch, _ in batches for index in batch.tolist()] == expected
+            assert all(torch.equal(targets, -batch) for batch, targets in batches)
@@ -0,0 +1,59 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from score_sde.models import layerspp
+from score_sde.models.ncsnpp_generator_adagn import NCSNpp
+from score_sde.models.up_or_down_sampling import Upsample2d
+from tests.test_ncsnpp import small_config, inputs
+
+
+@pytest.mark.parametrize('fir_kernel', [[1, 1], [1, 3, 3, 1], [1, 5, 10, 10, 5, 1]])
+@pytest.mark.parametrize('size', [(4, 4), (16, 16), (16, 12)])
+@pytest.mark.parametrize('kernel_size', [1, 3, 5])
+def test_upsample_conv(fir_kernel, size, kernel_size):
+    torch.manual_seed(0)
+    up = Upsample2d(fir_kernel).double()
+    x = torch.randn(2, 5, *size, dtype=torch.double)
+    w = torch.randn(7, 5, kernel_size, kernel_size, dtype=torch.double)
+    expected = F.conv2d(up(x), w, padding=kernel_size // 2)
+    assert torch.allclose(up.upsample_conv(x, w), expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('block', [layerspp.ResnetBlockBigGANpp_Adagn, layerspp.ResnetBlockBigGANpp_Adagn_one])
+@pytest.mark.parametrize('channels_last', [False, True])
+def test_fused_resample_block(block, channels_last):
+    torch.manual_seed(0)
+    kwargs = dict(act=nn.SiLU(), in_ch=16, out_ch=8, temb_dim=32, zemb_dim=32, up=True, fir=True)
+    unfused = block(**kwargs).double().eval()
+    fused = block(fused_resample=True, **kwargs).double().eval()
+    # init_scale=0 zeroes Conv_1; randomize all weights so the main path is compared too
+    for p in unfused.parameters():
+        p.data.normal_()
+    fused.load_state_dict(unfused.state_dict())
+
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    x = torch.randn(2, 16, 8, 8, dtype=torch.double).contiguous(memory_format=memory_format)
+    temb = torch.randn(2, 32, dtype=torch.double)
+    zemb = torch.randn(2, 32, dtype=torch.double)
+    assert torch.allclose(fused(x, temb, zemb), unfused(x, temb, zemb), rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('resblock_type', ['biggan', 'biggan_oneadagn'])
+def test_fused_resample_model(resblock_type):
+    torch.manual_seed(0)
+    config = small_config(resblock_type=resblock_type, ch_mult=[1, 2, 2])
+    unfused = NCSNpp(config).eval()
+    config.fused_resample = True
+    fused = NCSNpp(config).eval()
+    fused.load_state_dict(unfused.state_dict())
+    x, t, z = inputs(config)
+    with torch.no_grad():
+        assert torch.allclose(fused(x, t, z), unfused(x, t, z), rtol=0, atol=1e-5)
@@ -0,0 +1,60 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import io
+
+import pytest
+from PIL import Image
+
+from datasets_prep.lsun import LSUN
+
+lmdb = pytest.importorskip('lmdb')
+
+
+def write_class(path, class_id, size):
+    env = lmdb.open(str(path), map_size=2**20)
+    with env.begin(write=True) as txn:
+        for i in range(size):
+            buf = io.BytesIO()
+            Image.new('RGB', (1, 1), (class_id, i, 0)).save(buf, format='PNG')
+            txn.put('{:08x}'.format(i).encode(), buf.getvalue())
+    env.close()
+
+
+def linear_lookup(indices, index):
+    # the class lookup LSUN used before the bisect
+    target = 0
+    sub = 0
+    for ind in indices:
+        if index < ind:
+            break
+        target += 1
+        sub = ind
+    return target, index - sub
+
+
+def test_class_lookup(tmp_path):
+    categories = ['bedroom', 'bridge', 'church_outdoor', 'classroom', 'conference_room', 'dining_room',
+                  'kitchen', 'living_room', 'restaurant', 'tower', 'cat']
+    sizes = [3, 1, 0, 4, 2, 1, 0, 0, 5, 1, 2]
+    for class_id, (category, size) in enumerate(zip(categories, sizes)):
+        write_class(tmp_path / (category + '_train_lmdb'), class_id, size)
+
+    dataset = LSUN(str(tmp_path), classes='train')
+    assert len(dataset) == sum(sizes)
+    pixels = []
+    for index in range(len(dataset)):
+        img, target = dataset[index]
+        pixels.append(img.getpixel((0, 0)))
+        assert (target, pixels[-1][1]) == linear_lookup(dataset.indices, index)
+        assert pixels[-1][0] == target
+    for db in dataset.dbs:
+        db.env.close()
+
+    # the second time the keys come from their cache files
+    assert (tmp_path / 'bedroom_train_lmdb' / '_cache_keys.npy').is_file()
+    cached = LSUN(str(tmp_path), classes='train')
+    assert [cached[index][0].getpixel((0, 0)) for index in range(len(cached))] == pixels
@@ -0,0 +1,80 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import argparse
+
+import pytest
+import torch
+
+from score_sde.models.ncsnpp_generator_adagn import NCSNpp
+
+
+def small_config(**kwargs):
+    config = dict(num_channels=3, image_size=16, centered=True, num_channels_dae=16, n_mlp=2,
+                  ch_mult=[1, 2], num_res_blocks=1, attn_resolutions=(8,), dropout=0.,
+                  resamp_with_conv=True, conditional=True, fir=True, fir_kernel=[1, 3, 3, 1],
+                  skip_rescale=True, resblock_type='biggan', progressive='none',
+                  progressive_input='residual', progressive_combine='sum', embedding_type='positional',
+                  fourier_scale=16., not_use_tanh=False, nz=10, z_emb_dim=32)
+    config.update(kwargs)
+    return argparse.Namespace(**config)
+
+
+def inputs(config, batch_size=2):
+    x = torch.randn(batch_size, config.num_channels, config.image_size, config.image_size)
+    t = torch.rand(batch_size) + 0.1
+    z = torch.randn(batch_size, config.nz)
+    return x, t, z
+
+
+@pytest.mark.parametrize('embedding_type', ['fourier', 'positional'])
+def test_unconditional_ignores_time(embedding_type):
+    torch.manual_seed(0)
+    config = small_config(conditional=False, embedding_type=embedding_type)
+    netG = NCSNpp(config).eval()
+    x, t, z = inputs(config)
+    with torch.no_grad():
+        out = netG(x, t, z)
+        assert out.shape == x.shape
+        assert torch.equal(out, netG(x, t * 2, z))
+
+
+@pytest.mark.parametrize('embedding_type', ['fourier', 'positional'])
+def test_unconditional_loads_conditional_module_indices(embedding_type):
+    # The Fourier projection stays registered without conditioning, so the resnet
+    # blocks keep the indices they have in a conditional model.
+    conditional = NCSNpp(small_config(embedding_type=embedding_type))
+    unconditional = NCSNpp(small_config(conditional=False, embedding_type=embedding_type))
+    n_temb = 2
+    assert len(conditional.all_modules) == len(unconditional.all_modules) + n_temb
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(),
+    dict(resblock_type='ddpm'),
+    dict(resblock_type='biggan_oneadagn', progressive='output_skip', progressive_input='input_skip'),
+    dict(progressive='residual', progressive_combine='cat', embedding_type='fourier'),
+])
+def test_inference_matches_autograd(kwargs):
+    # Without autograd the residual sums, norms and activations run in place.
+    torch.manual_seed(0)
+    config = small_config(**kwargs)
+    netG = NCSNpp(config).eval()
+    x, t, z = inputs(config)
+    expected = netG(x, t, z).detach()
+    with torch.inference_mode():
+        assert torch.equal(netG(x, t, z), expected)
+
+
+def test_generate_in_chunks():
+    from test_ddgan import generate
+    torch.manual_seed(0)
+    config = small_config()
+    netG = NCSNpp(config).eval()
+    x, t, z = inputs(config, batch_size=5)
+    with torch.no_grad():
+        expected = netG(x, t, z)
+        assert torch.allclose(generate(netG, x, t, z, max_batch=2), expected, atol=1e-6)
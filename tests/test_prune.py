@@ -0,0 +1,44 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import pytest
+import torch
+
+from prune_ddgan import prune_generator
+from score_sde.models import layerspp
+from score_sde.models.ncsnpp_generator_adagn import NCSNpp
+from tests.test_ncsnpp import small_config, inputs
+
+
+def random_scores(netG):
+    scores = {}
+    for i, module in enumerate(netG.all_modules):
+        if isinstance(module, layerspp.ResnetBlockBigGANpp_Adagn):
+            scores[i] = torch.rand(module.Conv_0.out_channels)
+        elif isinstance(module, layerspp.AttnBlockpp):
+            scores[i] = (torch.rand(module.hidden_ch), torch.rand(module.hidden_ch))
+    return scores
+
+
+@pytest.mark.parametrize('resblock_type', ['biggan', 'ddpm', 'biggan_oneadagn'])
+def test_prune_generator(resblock_type):
+    torch.manual_seed(0)
+    netG = NCSNpp(small_config(resblock_type=resblock_type)).eval()
+    pruned, config = prune_generator(netG, random_scores(netG), 0.5)
+    attn_widths = [m.hidden_ch for m in netG.all_modules if isinstance(m, layerspp.AttnBlockpp)]
+    assert config.attn_hidden_ch == [w // 2 for w in attn_widths]
+    if resblock_type == 'biggan':
+        assert config.resblock_hidden_ch is not None
+    else:
+        assert config.resblock_hidden_ch is None
+    assert sum(p.numel() for p in pruned.parameters()) < sum(p.numel() for p in netG.parameters())
+
+    x, t, z = inputs(config)
+    with torch.no_grad():
+        assert pruned(x, t, z).shape == x.shape
+    # the saved config rebuilds the pruned model
+    NCSNpp(config).load_state_dict(pruned.state_dict())
+
@@ -0,0 +1,67 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import pytest
+import torch
+import torch.nn.quantized as nnq
+
+from quantize_ddgan import quantize_generator
+from score_sde.models.ncsnpp_generator_adagn import NCSNpp
+from test_ddgan import get_parser, get_time_schedule, Posterior_Coefficients, sample_batch, \
+    sample_from_model
+
+
+def sampling_args(*flags):
+    args = get_parser().parse_args(['--image_size', '16', '--num_channels_dae', '16', '--ch_mult', '1', '2',
+                                    '--num_res_blocks', '1', '--nz', '10', '--z_emb_dim', '32',
+                                    '--t_emb_dim', '32', '--batch_size', '2', *flags])
+    args.attn_resolutions = (8,)
+    args.calib_batches = 1
+    return args
+
+
+def test_quantize_fused_resample():
+    # The quantization wrappers replace the convs whose weights the fused up blocks read.
+    args = sampling_args()
+    fused_args = sampling_args('--fused_resample')
+    T = get_time_schedule(args, 'cpu')
+    pos_coeff = Posterior_Coefficients(args, 'cpu')
+    torch.manual_seed(0)
+    netG = NCSNpp(args).eval()
+    fused = NCSNpp(fused_args).eval()
+    fused.load_state_dict(netG.state_dict())
+
+    samples = []
+    for model, model_args in [(netG, args), (fused, fused_args)]:
+        torch.manual_seed(1)
+        qnetG = quantize_generator(model, pos_coeff, T, model_args)
+        samples.append(sample_batch(qnetG, pos_coeff, T, model_args, 'cpu'))
+    assert torch.equal(*samples)
+
+
+@pytest.mark.parametrize('flags', [[], ['--resblock_type', 'biggan_oneadagn'], ['--channels_last'],
+                                   ['--fused_resample', '--fused_adagn', '--channels_last']])
+def test_quantized_sampling(flags):
+    args = sampling_args(*flags)
+    T = get_time_schedule(args, 'cpu')
+    pos_coeff = Posterior_Coefficients(args, 'cpu')
+    torch.manual_seed(0)
+    qnetG = quantize_generator(NCSNpp(args).eval(), pos_coeff, T, args)
+    assert any(isinstance(module, nnq.Conv2d) for module in qnetG.modules())
+    assert any(isinstance(module, nnq.Linear) for module in qnetG.modules())
+
+    x = torch.randn(args.batch_size, args.num_channels, args.image_size, args.image_size)
+    samples = sample_from_model(pos_coeff, qnetG, args.num_timesteps, x, T, args)
+    assert samples.shape == x.shape
+    assert torch.isfinite(samples).all()
+
+
+def test_quantize_rejects_fourier_embedding():
+    args = sampling_args('--embedding_type', 'fourier')
+    T = get_time_schedule(args, 'cpu')
+    pos_coeff = Posterior_Coefficients(args, 'cpu')
+    with pytest.raises(ValueError, match='fourier'):
+        quantize_generator(NCSNpp(args).eval(), pos_coeff, T, args)
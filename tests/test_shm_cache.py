@@ -0,0 +1,48 @@
+# ---------------------------------------------------------------
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the NVIDIA Source Code License
+# for Denoising Diffusion GAN. To view a copy of this license, see the LICENSE file.
+# ---------------------------------------------------------------
+import multiprocessing
+import os
+
+import pytest
+import torch
+import torch.utils.data as data
+
+from datasets_prep.shm_cache import SharedMemoryCache
+
+
+def dataset():
+    return data.TensorDataset(torch.arange(4 * 12, dtype=torch.uint8).view(4, 3, 2, 2), torch.arange(4))
+
+
+def own_cache(path, fail):
+    cache = SharedMemoryCache(dataset(), path, size_bytes=24, create=True)
+    # a child of the owner, like a DataLoader worker, exits without removing the cache
+    child = multiprocessing.get_context('fork').Process(target=cache.__getitem__, args=(1,))
+    child.start()
+    child.join()
+    assert os.path.isdir(path)
+    if fail:
+        raise RuntimeError('training crashed')
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_owner_exit_removes_cache(tmp_path, fail):
+    path = str(tmp_path / 'cache')
+    owner = multiprocessing.get_context('fork').Process(target=own_cache, args=(path, fail))
+    owner.start()
+    owner.join()
+    assert owner.exitcode == int(fail)
+    assert not os.path.exists(path)
+
+
+def test_cached_samples(tmp_path):
+    cache = SharedMemoryCache(dataset(), str(tmp_path / 'cache'), size_bytes=24, create=True)
+    for index in [0, 1, 0, 2, 3, 1]:
+        img, target = cache[index]
+        assert torch.equal(img, dataset()[index][0]) and target == index
+    cache.destroy()
+    assert not os.path.exists(cache.path)
@@ -22,11 +22,18 @@ from torchvision.datasets import CIFAR10
 from datasets_prep.lsun import LSUN
 from datasets_prep.stackmnist_data import StackedMNIST, _data_transforms_stacked_mnist
 from datasets_prep.lmdb_datasets import LMDBDataset
+from datasets_prep.memmap_dataset import MemmapDataset
+from datasets_prep.batched_augment import uint8_transform, batched_augment
+from datasets_prep.in_memory import InMemoryLoader, dataset_tensors
+from datasets_prep.shm_cache import SharedMemoryCache
 
 
 from torch.multiprocessing import Process
+from torch.utils.data.dataloader import default_collate
 import torch.distributed as dist
 import shutil
+import signal
+import sys
 
 def copy_source(file, output_dir):
     shutil.copyfile(file, os.path.join(output_dir, os.path.basename(file)))
@@ -97,31 +104,68 @@ class Diffusion_Coefficients():
         self.sigmas_cum = self.sigmas_cum.to(device)
         self.a_s_prev = self.a_s_prev.to(device)
     
-def q_sample(coeff, x_start, t, *, noise=None):
+def _randn(x, generator):
+    if generator is None:
+        return torch.randn_like(x)
+    return torch.randn(x.shape, generator=generator, dtype=x.dtype, device=x.device)
+
+def q_sample(coeff, x_start, t, *, noise=None, generator=None):
     """
     Diffuse the data (t == 0 means diffused for t step)
     """
     if noise is None:
-      noise = torch.randn_like(x_start)
+      noise = _randn(x_start, generator)
       
     x_t = extract(coeff.a_s_cum, t, x_start.shape) * x_start + \
           extract(coeff.sigmas_cum, t, x_start.shape) * noise
     
     return x_t
 
-def q_sample_pairs(coeff, x_start, t):
+def q_sample_pairs(coeff, x_start, t, generator=None):
     """
     Generate a pair of disturbed images for training
     :param x_start: x_0
     :param t: time step t
     :return: x_t, x_{t+1}
     """
-    noise = torch.randn_like(x_start)
-    x_t = q_sample(coeff, x_start, t)
+    noise = _randn(x_start, generator)
+    x_t = q_sample(coeff, x_start, t, generator=generator)
     x_t_plus_one = extract(coeff.a_s, t+1, x_start.shape) * x_t + \
                    extract(coeff.sigmas, t+1, x_start.shape) * noise
     
     return x_t, x_t_plus_one
+
+class DiffusionPairCollate():
+    """
+    Collates a batch of x_0 and samples (t, x_t, x_tp1) for both the D and the G step
+    of the iteration, in the DataLoader workers with CPU coefficients.
+    Each worker draws from its own generator, seeded with the worker seed that the
+    DataLoader derives from the trainer's seed.
+    """
+    def __init__(self, coeff, num_timesteps):
+        self.coeff = coeff
+        self.num_timesteps = num_timesteps
+        self.generator = None
+        self.pid = None
+
+    def _sample(self, x):
+        t = torch.randint(0, self.num_timesteps, (x.size(0),), generator=self.generator)
+        x_t, x_tp1 = q_sample_pairs(self.coeff, x, t, generator=self.generator)
+        return t, x_t, x_tp1
+
+    def __call__(self, batch):
+        if self.pid != os.getpid():
+            self.generator = torch.Generator()
+            self.generator.manual_seed(torch.initial_seed())
+            self.pid = os.getpid()
+        x, y = default_collate(batch)
+        return x, y, self._sample(x), self._sample(x)
+
+def pair_to_device(pair, device, memory_format):
+    t, x_t, x_tp1 = pair
+    return (t.to(device, non_blocking=True),
+            x_t.to(device, non_blocking=True, memory_format=memory_format),
+            x_tp1.to(device, non_blocking=True, memory_format=memory_format))
 #%% posterior sampling
 class Posterior_Coefficients():
     def __init__(self, args, device):
@@ -174,7 +218,8 @@ def sample_posterior(coefficients, x_0,x_t, t):
 
 def sample_from_model(coefficients, generator, n_time, x_init, T, opt):
     x = x_init
-    with torch.no_grad():
+    # inference_mode is not available before torch 1.9.
+    with getattr(torch, 'inference_mode', torch.no_grad)():
         for i in reversed(range(n_time)):
             t = torch.full((x.size(0),), i, dtype=torch.int64).to(x.device)
           
@@ -186,10 +231,25 @@ def sample_from_model(coefficients, generator, n_time, x_init, T, opt):
         
     return x
 
+def r1_penalty(D_real, x_t, args):
+    grad_real = torch.autograd.grad(
+                outputs=D_real.sum(), inputs=x_t, create_graph=True
+                )[0]
+    grad_penalty = (
+                    grad_real.reshape(grad_real.size(0), -1).norm(2, dim=1) ** 2
+                    ).mean()
+    
+    grad_penalty = args.r1_gamma / 2 * grad_penalty
+    if args.lazy_reg is not None and args.lazy_reg_scale:
+        # applied every lazy_reg steps, so weight it accordingly (StyleGAN2)
+        grad_penalty = grad_penalty * args.lazy_reg
+    return grad_penalty
+
 #%%
 def train(rank, gpu, args):
     from score_sde.models.discriminator import Discriminator_small, Discriminator_large
     from score_sde.models.ncsnpp_generator_adagn import NCSNpp
+    from score_sde.models.utils import find_layout_conversions
     from EMA import EMA
     
     torch.manual_seed(args.seed + rank)
@@ -201,21 +261,44 @@ def train(rank, gpu, args):
     
     nz = args.nz #latent dimension
     
-    if args.dataset == 'cifar10':
-        dataset = CIFAR10('./data', train=True, transform=transforms.Compose([
+    # --in_memory and --shm_cache_gb serve uint8 batches, which are then augmented like --batched_augment ones
+    if args.in_memory or args.shm_cache_gb is not None:
+        args.batched_augment = True
+    if args.pipeline_diffusion and args.batched_augment:
+        raise ValueError('--pipeline_diffusion diffuses the augmented images in the workers, '
+                         'so it cannot be combined with --batched_augment, --in_memory or --shm_cache_gb')
+
+    # with --batched_augment the datasets return uint8 tensors and these run per batch
+    augment_flip, augment_pad = True, 0
+
+    if args.memmap_path is not None:
+        dataset = MemmapDataset(args.memmap_path, uint8=args.batched_augment)
+
+    elif args.dataset == 'cifar10':
+        if args.batched_augment:
+            transform = uint8_transform(32)
+        else:
+            transform = transforms.Compose([
                         transforms.Resize(32),
                         transforms.RandomHorizontalFlip(),
                         transforms.ToTensor(),
-                        transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5))]), download=True)
+                        transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5))])
+        dataset = CIFAR10('./data', train=True, transform=transform, download=True)
        
     
     elif args.dataset == 'stackmnist':
         train_transform, valid_transform = _data_transforms_stacked_mnist()
+        if args.batched_augment:
+            train_transform = None
+            augment_flip, augment_pad = False, 2
         dataset = StackedMNIST(root='./data', train=True, download=False, transform=train_transform)
         
     elif args.dataset == 'lsun':
         
-        train_transform = transforms.Compose([
+        if args.batched_augment:
+            train_transform = uint8_transform(args.image_size, center_crop=True)
+        else:
+            train_transform = transforms.Compose([
                         transforms.Resize(args.image_size),
                         transforms.CenterCrop(args.image_size),
                         transforms.RandomHorizontalFlip(),
@@ -229,7 +312,10 @@ def train(rank, gpu, args):
       
     
     elif args.dataset == 'celeba_256':
-        train_transform = transforms.Compose([
+        if args.batched_augment:
+            train_transform = uint8_transform(args.image_size)
+        else:
+            train_transform = transforms.Compose([
                 transforms.Resize(args.image_size),
                 transforms.RandomHorizontalFlip(),
                 transforms.ToTensor(),
@@ -238,29 +324,58 @@ def train(rank, gpu, args):
         dataset = LMDBDataset(root='/datasets/celeba-lmdb/', name='celeba', train=True, transform=train_transform)
       
     
-    
-    train_sampler = torch.utils.data.distributed.DistributedSampler(dataset,
-                                                                    num_replicas=args.world_size,
-                                                                    rank=rank)
-    data_loader = torch.utils.data.DataLoader(dataset,
-                                               batch_size=batch_size,
-                                               shuffle=False,
-                                               num_workers=4,
-                                               pin_memory=True,
-                                               sampler=train_sampler,
-                                               drop_last = True)
-    
-    netG = NCSNpp(args).to(device)
+    # Local rank 0 creates the node's cache; the other ranks open it after the barrier.
+    shm_cache = None
+    if args.shm_cache_gb is not None and not args.in_memory:
+        shm_cache = SharedMemoryCache(dataset, os.path.join(args.shm_cache_dir, 'ddgan_{}_{}'.format(args.dataset, args.exp)),
+                                      size_bytes=int(args.shm_cache_gb * 2**30), create=args.local_rank == 0)
+        if args.local_rank == 0:
+            # exit through SystemExit on SIGTERM, so the cache is removed on the way out
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        dist.barrier()
+        dataset = shm_cache
+    
+    if args.in_memory:
+        data_loader = InMemoryLoader(*dataset_tensors(dataset), batch_size,
+                                     num_replicas=args.world_size, rank=rank, device=device)
+        train_sampler = data_loader
+    else:
+        collate_fn = None
+        if args.pipeline_diffusion:
+            collate_fn = DiffusionPairCollate(Diffusion_Coefficients(args, 'cpu'), args.num_timesteps)
+        train_sampler = torch.utils.data.distributed.DistributedSampler(dataset,
+                                                                        num_replicas=args.world_size,
+                                                                        rank=rank)
+        data_loader = torch.utils.data.DataLoader(dataset,
+                                                   batch_size=batch_size,
+                                                   shuffle=False,
+                                                   num_workers=4,
+                                                   pin_memory=True,
+                                                   sampler=train_sampler,
+                                                   collate_fn=collate_fn,
+                                                   drop_last = True)
+    
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    
+    netG = NCSNpp(args).to(device, memory_format=memory_format)
     
 
     if args.dataset == 'cifar10' or args.dataset == 'stackmnist':    
         netD = Discriminator_small(nc = 2*args.num_channels, ngf = args.ngf,
                                t_emb_dim = args.t_emb_dim,
-                               act=nn.LeakyReLU(0.2)).to(device)
+                               act=nn.LeakyReLU(0.2)).to(device, memory_format=memory_format)
     else:
         netD = Discriminator_large(nc = 2*args.num_channels, ngf = args.ngf, 
                                    t_emb_dim = args.t_emb_dim,
-                                   act=nn.LeakyReLU(0.2)).to(device)
+                                   act=nn.LeakyReLU(0.2)).to(device, memory_format=memory_format)
+    
+    if args.channels_last and rank == 0:
+        x = torch.randn(2, args.num_channels, args.image_size, args.image_size, device=device)
+        x = x.to(memory_format=memory_format)
+        t = torch.zeros(2, dtype=torch.int64, device=device)
+        z = torch.randn(2, nz, device=device)
+        print('channels_last conversions in G: {}, D: {}'.format(
+            find_layout_conversions(netG, x, t, z), find_layout_conversions(netD, x, t, x)))
     
     broadcast_params(netG.parameters())
     broadcast_params(netD.parameters())
@@ -321,69 +436,85 @@ def train(rank, gpu, args):
     for epoch in range(init_epoch, args.num_epoch+1):
         train_sampler.set_epoch(epoch)
        
-        for iteration, (x, y) in enumerate(data_loader):
+        # with --pipeline_diffusion, pairs holds the (t, x_t, x_tp1) of the D and the G step
+        for iteration, (x, y, *pairs) in enumerate(data_loader):
             for p in netD.parameters():  
                 p.requires_grad = True  
         
             
             netD.zero_grad()
             
-            #sample from p(x_0)
-            real_data = x.to(device, non_blocking=True)
-            
-            #sample t
-            t = torch.randint(0, args.num_timesteps, (real_data.size(0),), device=device)
-            
-            x_t, x_tp1 = q_sample_pairs(coeff, real_data, t)
-            x_t.requires_grad = True
-            
-    
-            # train with real
-            D_real = netD(x_t, t, x_tp1.detach()).view(-1)
+            #sample t; with --pipeline_diffusion the workers already did, and x_0 stays on the host
+            if pairs:
+                t, x_t, x_tp1 = pair_to_device(pairs[0], device, memory_format)
+            else:
+                #sample from p(x_0)
+                if args.batched_augment:
+                    real_data = batched_augment(x.to(device, non_blocking=True), augment_flip, augment_pad)
+                    real_data = real_data.contiguous(memory_format=memory_format)
+                else:
+                    real_data = x.to(device, non_blocking=True, memory_format=memory_format)
+                
+                t = torch.randint(0, args.num_timesteps, (real_data.size(0),), device=device)
+                
+                x_t, x_tp1 = q_sample_pairs(coeff, real_data, t)
+            r1_step = args.lazy_reg is None or global_step % args.lazy_reg == 0
+            # the inline R1 penalty differentiates this pass, so it needs the input grad and graph
+            inline_r1 = r1_step and not args.decoupled_r1
+            x_t.requires_grad = inline_r1
+            
+    
+            if args.joint_d_pass:
+                # real and fake in a single D batch; stddev groups stay within each half
+                latent_z = torch.randn(batch_size, nz, device=device)
+                with torch.no_grad():
+                    x_0_predict = netG(x_tp1.detach(), t, latent_z)
+                    x_pos_sample = sample_posterior(pos_coeff, x_0_predict, x_tp1, t)
+                D_out = netD(torch.cat([x_t, x_pos_sample]), torch.cat([t, t]),
+                             torch.cat([x_tp1.detach(), x_tp1.detach()]), num_splits=2).view(-1)
+                D_real, output = D_out.chunk(2)
+            else:
+                # train with real
+                D_real = netD(x_t, t, x_tp1.detach()).view(-1)
             
             errD_real = F.softplus(-D_real)
             errD_real = errD_real.mean()
             
-            errD_real.backward(retain_graph=True)
+            if args.joint_d_pass:
+                errD_fake = F.softplus(output)
+                errD_fake = errD_fake.mean()
+                (errD_real + errD_fake).backward(retain_graph=inline_r1)
+            else:
+                errD_real.backward(retain_graph=inline_r1)
             
             
-            if args.lazy_reg is None:
-                grad_real = torch.autograd.grad(
-                            outputs=D_real.sum(), inputs=x_t, create_graph=True
-                            )[0]
-                grad_penalty = (
-                                grad_real.view(grad_real.size(0), -1).norm(2, dim=1) ** 2
-                                ).mean()
-                
-                
-                grad_penalty = args.r1_gamma / 2 * grad_penalty
+            if inline_r1:
+                grad_penalty = r1_penalty(D_real, x_t, args)
                 grad_penalty.backward()
-            else:
-                if global_step % args.lazy_reg == 0:
-                    grad_real = torch.autograd.grad(
-                            outputs=D_real.sum(), inputs=x_t, create_graph=True
-                            )[0]
-                    grad_penalty = (
-                                grad_real.view(grad_real.size(0), -1).norm(2, dim=1) ** 2
-                                ).mean()
-                
-                
-                    grad_penalty = args.r1_gamma / 2 * grad_penalty
-                    grad_penalty.backward()
+            elif r1_step:
+                # dedicated R1 pass on the first r1_batch_fraction of the real batch
+                n = max(1, int(x_t.size(0) * args.r1_batch_fraction))
+                group = netD.module.stddev_group
+                if n > group:
+                    n -= n % group
+                x_r = x_t[:n].detach().requires_grad_()
+                D_r = netD(x_r, t[:n], x_tp1[:n].detach()).view(-1)
+                grad_penalty = r1_penalty(D_r, x_r, args)
+                # D_r * 0 hands DDP a (zero) gradient for the parameters the penalty does not reach
+                (grad_penalty + D_r.sum() * 0).backward()
 
             # train with fake
-            latent_z = torch.randn(batch_size, nz, device=device)
-            
-         
-            x_0_predict = netG(x_tp1.detach(), t, latent_z)
-            x_pos_sample = sample_posterior(pos_coeff, x_0_predict, x_tp1, t)
-            
-            output = netD(x_pos_sample, t, x_tp1.detach()).view(-1)
-                
-            
-            errD_fake = F.softplus(output)
-            errD_fake = errD_fake.mean()
-            errD_fake.backward()
+            if not args.joint_d_pass:
+                latent_z = torch.randn(batch_size, nz, device=device)
+
+                x_0_predict = netG(x_tp1.detach(), t, latent_z)
+                x_pos_sample = sample_posterior(pos_coeff, x_0_predict, x_tp1, t)
+
+                output = netD(x_pos_sample, t, x_tp1.detach()).view(-1)
+
+                errD_fake = F.softplus(output)
+                errD_fake = errD_fake.mean()
+                errD_fake.backward()
     
             
             errD = errD_real + errD_fake
@@ -397,10 +528,13 @@ def train(rank, gpu, args):
             netG.zero_grad()
             
             
-            t = torch.randint(0, args.num_timesteps, (real_data.size(0),), device=device)
-            
-            
-            x_t, x_tp1 = q_sample_pairs(coeff, real_data, t)
+            if pairs:
+                t, x_t, x_tp1 = pair_to_device(pairs[1], device, memory_format)
+            else:
+                t = torch.randint(0, args.num_timesteps, (real_data.size(0),), device=device)
+                
+                
+                x_t, x_tp1 = q_sample_pairs(coeff, real_data, t)
                 
             
             latent_z = torch.randn(batch_size, nz,device=device)
@@ -436,7 +570,7 @@ def train(rank, gpu, args):
             if epoch % 10 == 0:
                 torchvision.utils.save_image(x_pos_sample, os.path.join(exp_path, 'xpos_epoch_{}.png'.format(epoch)), normalize=True)
             
-            x_t_1 = torch.randn_like(real_data)
+            x_t_1 = torch.randn_like(x_t)
             fake_sample = sample_from_model(pos_coeff, netG, args.num_timesteps, x_t_1, T, args)
             torchvision.utils.save_image(fake_sample, os.path.join(exp_path, 'sample_discrete_epoch_{}.png'.format(epoch)), normalize=True)
             
@@ -457,6 +591,11 @@ def train(rank, gpu, args):
                 torch.save(netG.state_dict(), os.path.join(exp_path, 'netG_{}.pth'.format(epoch)))
                 if args.use_ema:
                     optimizerG.swap_parameters_with_ema(store_params_in_ema=True)
+    
+    if shm_cache is not None:
+        dist.barrier()
+        if args.local_rank == 0:
+            shm_cache.destroy()
             
 
 
@@ -530,10 +669,28 @@ if __name__ == '__main__':
     parser.add_argument('--fourier_scale', type=float, default=16.,
                             help='scale of fourier transform')
     parser.add_argument('--not_use_tanh', action='store_true',default=False)
+    parser.add_argument('--channels_last', action='store_true', default=False,
+                        help='run G and D in channels_last memory format')
+    parser.add_argument('--fused_adagn', action='store_true', default=False,
+                        help='fuse adaptive group norm, modulation and SiLU in the resnet blocks')
+    parser.add_argument('--fused_resample', action='store_true', default=False,
+                        help='fuse FIR upsampling into the convs of the BigGAN up blocks (faster with --channels_last)')
     
     #geenrator and training
     parser.add_argument('--exp', default='experiment_cifar_default', help='name of experiment')
     parser.add_argument('--dataset', default='cifar10', help='name of dataset')
+    parser.add_argument('--memmap_path', default=None,
+                        help='train from a .npy file written by datasets_prep/memmap_dataset.py')
+    parser.add_argument('--batched_augment', action='store_true', default=False,
+                        help='load uint8 images and flip/normalize whole batches on the device')
+    parser.add_argument('--in_memory', action='store_true', default=False,
+                        help='hold cifar10/stackmnist (or a memmap file) as one uint8 tensor on the device')
+    parser.add_argument('--shm_cache_gb', type=float, default=None,
+                        help='cache up to this many GB of decoded uint8 images in shared memory, once per node')
+    parser.add_argument('--shm_cache_dir', default='/dev/shm',
+                        help='directory of the --shm_cache_gb cache')
+    parser.add_argument('--pipeline_diffusion', action='store_true', default=False,
+                        help='sample t, x_t and x_tp1 in the DataLoader workers instead of on the device')
     parser.add_argument('--nz', type=int, default=100)
     parser.add_argument('--num_timesteps', type=int, default=4)
 
@@ -555,9 +712,17 @@ if __name__ == '__main__':
                             help='use EMA or not')
     parser.add_argument('--ema_decay', type=float, default=0.9999, help='decay rate for EMA')
     
+    parser.add_argument('--joint_d_pass', action='store_true', default=False,
+                        help='run D once on the concatenated real and fake batch')
     parser.add_argument('--r1_gamma', type=float, default=0.05, help='coef for r1 reg')
     parser.add_argument('--lazy_reg', type=int, default=None,
                         help='lazy regulariation.')
+    parser.add_argument('--lazy_reg_scale', action='store_true', default=False,
+                        help='multiply the lazy R1 penalty by the lazy_reg interval')
+    parser.add_argument('--decoupled_r1', action='store_true', default=False,
+                        help='compute R1 in its own D pass, only on regularization steps')
+    parser.add_argument('--r1_batch_fraction', type=float, default=1.,
+                        help='fraction of the real batch used by the decoupled R1 pass')
 
     parser.add_argument('--save_content', action='store_true',default=False)
     parser.add_argument('--save_content_every', type=int, default=50, help='save content for resuming every x epochs')